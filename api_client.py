@@ -0,0 +1,104 @@
+import json
+import os
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from instrumentation import span
+
+class PaginatedClient:
+    '''
+    Client for the paginated Angstrom API endpoints.
+    Requests share one pooled session and are retried with exponential backoff.
+    Pages are appended to an NDJSON file (one result per line) as they arrive, and after every page
+    the queryExecutionId/nextToken are checkpointed, so an interrupted download resumes where it stopped.
+    base_url can point at a local stub server for testing.
+    '''
+    def __init__(self, base_url, timeout=30, retries=5, backoff_factor=0.5):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"])
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=4, pool_maxsize=4)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get_page(self, endpoint, params=None):
+        with span("api.get_page", endpoint=endpoint) as s:
+            response = self.session.get(self.base_url + endpoint, params=params, timeout=self.timeout)
+            response.raise_for_status()
+            s.add(bytes_downloaded=len(response.content))
+            return response.json()
+
+    def fetch(self, endpoint, output_path):
+        '''
+        Download every page of endpoint into output_path (a JSON list, as before).
+        The results are streamed to output_path with a .ndjson extension first, which is kept.
+        '''
+        ndjson_path = os.path.splitext(output_path)[0] + ".ndjson"
+        checkpoint_path = ndjson_path + ".checkpoint"
+
+        checkpoint = self.read_checkpoint(checkpoint_path)
+        if checkpoint is None:
+            page = self.get_page(endpoint)
+            with open(ndjson_path, "w") as f:
+                pass
+            checkpoint = {"queryExecutionId": page["queryExecutionId"],
+                          "columns": json.dumps(page["columns"], separators=(",", ":")),
+                          "nextToken": None,
+                          "pages": 0,
+                          "offset": 0}
+        else:
+            page = None
+
+        with open(ndjson_path, "r+") as f:
+            # Drop anything written after the last checkpoint, e.g. half a page from a crash
+            f.truncate(checkpoint["offset"])
+            f.seek(checkpoint["offset"])
+
+            while True:
+                if page is None:
+                    params = {"queryExecutionId": checkpoint["queryExecutionId"],
+                              "nextToken": checkpoint["nextToken"],
+                              "columns": checkpoint["columns"]}
+                    page = self.get_page(endpoint, params)
+
+                for result in page["results"]:
+                    f.write(json.dumps(result) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+                checkpoint["nextToken"] = page["nextToken"]
+                checkpoint["pages"] += 1
+                checkpoint["offset"] = f.tell()
+                if not page["nextToken"]:
+                    break
+                self.write_checkpoint(checkpoint_path, checkpoint)
+                page = None
+
+        write_json_list(ndjson_path, output_path)
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+    def read_checkpoint(self, checkpoint_path):
+        if not os.path.exists(checkpoint_path):
+            return None
+        with open(checkpoint_path, "r") as f:
+            return json.load(f)
+
+    def write_checkpoint(self, checkpoint_path, checkpoint):
+        # Write then rename, so the checkpoint is never left half written
+        with open(checkpoint_path + ".tmp", "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(checkpoint_path + ".tmp", checkpoint_path)
+
+# Convert an NDJSON file into a JSON list one line at a time, without loading it all into memory.
+# Written then renamed, so output_path only ever holds a finished download.
+def write_json_list(ndjson_path, output_path):
+    with open(ndjson_path, "r") as src, open(output_path + ".tmp", "w") as dst:
+        dst.write("[")
+        for i, line in enumerate(src):
+            if i:
+                dst.write(", ")
+            dst.write(line.rstrip("\n"))
+        dst.write("]")
+    os.replace(output_path + ".tmp", output_path)
@@ -0,0 +1,307 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from data_collection import MissingDataError
+from instrumentation import instrumented, count
+
+'''
+Backtests of the models against past contests, scored with the Brier score, log loss and calibration curves.
+
+    python contest.py backtest --model bayesian log_reg --workers 4
+    python contest.py backtest --model bayesian --k 0.1 0.3 0.5 1
+
+    from backtest import backtest
+    report = backtest([{"model": "bayesian", "k": 0.3}, {"model": "log_reg"}], workers=4)
+
+Every contest is replayed with each player's model built only from what was known before it: the shots in their
+shot chart from before the contest date, and their results in earlier contests. Building the models (training a
+log_reg model for every player and contest is the slow part) runs on a process pool, and each round score
+distribution is stored in BACKTEST_CACHE under its (player, contest, model config), so a re-run only builds what is new.
+
+Contests from before the first shot chart season are scored separately, under "before_shot_charts" in each report:
+every bayesian forecast in them falls back to FALLBACK_PRIOR, and no log_reg model can be built.
+'''
+
+# Past contests to replay, in the format described in load_contest_history
+CONTEST_HISTORY = "data/contest_history.json"
+BACKTEST_CACHE = "data/backtest_cache.json"
+# Raised whenever the way score distributions are built changes, so the cached ones are built again
+CACHE_VERSION = 2
+# Games of shooting before a contest that the bayesian prior is built from, as in the live model
+PRIOR_GAMES = 100
+# Fewest shots before a contest to train a log_reg model on
+MIN_SHOTS = 50
+# Boxscore three point attempts per shot chart attempt for players without boxscores to measure their own by.
+# Shot charts only hold jump shot threes, from a third to two thirds of a player's attempts.
+DEFAULT_ATTEMPT_SCALE = 2.0
+# Probabilities are floored at this in the log loss, so an impossible outcome doesn't give an infinite score
+EPSILON = 1e-15
+
+def load_contest_history(path=CONTEST_HISTORY):
+    '''
+    Past contests, oldest first. Each is {"date": "YYYY-MM-DD", "players": [...], "winner": playerid}, and can give a
+    "format" (see CONTEST_FORMAT, the current format by default). Each player is {"playerid", "scores" (their score
+    in each round they shot), "made", "att", "dewmade", "dewatt" (their shooting over the whole contest)}, and can
+    give a "money_rack" (4 by default).
+    '''
+    if not os.path.exists(path):
+        raise MissingDataError(f"No contest history at {path}. It should be a JSON list of past contests, each "
+                               f"{{\"date\": \"YYYY-MM-DD\", \"winner\": playerid, \"players\": [{{\"playerid\", \"scores\", \"made\", "
+                               f"\"att\", \"dewmade\", \"dewatt\"}}, ...]}} (see backtest.load_contest_history)")
+    with open(path, "r") as f:
+        contests = json.load(f)
+    return sorted(contests, key=lambda contest: contest["date"])
+
+# A model config with every setting filled in, so that equivalent configs share their cache entries
+def get_config(config):
+    from bayesian import PRIOR_WEIGHT
+    from logistic_regression import CONTEST_UPLIFT
+
+    model = config.get("model", "bayesian")
+    k = config.get("k")
+    if model == "bayesian":
+        # The fitted settings are fitted to every contest, so they would leak the results being forecast
+        return {"model": model, "k": float(PRIOR_WEIGHT if k is None else k), "uplift": float(config.get("uplift") or 1.0)}
+    elif model == "log_reg":
+        return {"model": model, "k": float(CONTEST_UPLIFT if k is None else k)}
+    else:
+        raise ValueError(f"Unknown model: {model}")
+
+def get_config_key(config):
+    return json.dumps(config, sort_keys=True)
+
+def load_cache():
+    if not os.path.exists(BACKTEST_CACHE):
+        return {"version": CACHE_VERSION}
+    with open(BACKTEST_CACHE, "r") as f:
+        cache = json.load(f)
+    if cache.get("version") != CACHE_VERSION:
+        return {"version": CACHE_VERSION}
+    return cache
+
+def save_cache(cache):
+    with open(BACKTEST_CACHE + ".tmp", "w") as f:
+        json.dump(cache, f)
+    os.replace(BACKTEST_CACHE + ".tmp", BACKTEST_CACHE)
+
+# A player's whole shot chart, or None if they have no shot chart
+def get_shots(playerid):
+    from shot_charts import read_shot_chart, has_shot_chart
+    from logistic_regression import pipeline_config
+
+    if not has_shot_chart(playerid):
+        return None
+    return read_shot_chart(playerid, ["GAME_ID", "GAME_DATE"] + pipeline_config["features"] + ["SHOT_MADE_FLAG"])
+
+def get_shots_before(shots, date):
+    if shots is None:
+        return None
+    # GAME_DATE is stored as YYYYMMDD
+    return shots[shots["GAME_DATE"] < int(date.replace("-", ""))]
+
+# A player's shots over their last PRIOR_GAMES games in the shot chart
+def get_recent_shots(shots):
+    games = shots.groupby("GAME_ID")["GAME_DATE"].first().sort_values().index[-PRIOR_GAMES:]
+    return shots[shots["GAME_ID"].isin(games)]
+
+def get_attempt_scale(playerid, shots):
+    '''
+    A player's boxscore three point attempts per shot chart attempt, over their last PRIOR_GAMES games of each.
+    The boxscores have no dates to take the attempts before a contest from, so the shot chart attempts are scaled by
+    this instead. It is measured on the latest games, not those before the contest, but it is only a ratio of shot types.
+    '''
+    from boxscore_store import get_store
+
+    store = get_store()
+    if shots is None or not len(shots) or not store.has_player(playerid):
+        return DEFAULT_ATTEMPT_SCALE
+    att = int(store.get_last_n(playerid, "threepointersattempted", PRIOR_GAMES).sum())
+    return att / len(get_recent_shots(shots)) if att else DEFAULT_ATTEMPT_SCALE
+
+def get_bayesian_params(shots, previous, k, uplift, attempt_scale=DEFAULT_ATTEMPT_SCALE):
+    '''
+    Posterior for one player as of a contest, like bayesian.get_priors and update but from the shot chart: the 20-24ft/25-29ft
+    split over their last PRIOR_GAMES games, and their earlier contest results. The shot chart only has jump shots, so
+    its attempts are scaled by attempt_scale (see get_attempt_scale) to weigh the prior like the live boxscore attempts.
+    '''
+    from bayesian import get_prior_params, FALLBACK_PRIOR
+
+    prior = FALLBACK_PRIOR
+    if shots is not None and len(shots):
+        recent = get_recent_shots(shots)
+        made = recent["SHOT_MADE_FLAG"].to_numpy()
+        short = recent["SHOT_DISTANCE"].between(20, 24).to_numpy()
+        long = recent["SHOT_DISTANCE"].between(25, 29).to_numpy()
+        if short.sum() + long.sum() > 0:
+            pc_reg = made[short].sum() / max(short.sum(), 1)
+            pc_dew = made[long].sum() / max(long.sum(), 1)
+            prior = get_prior_params(pc_reg, pc_dew, len(recent) * attempt_scale, long.sum() / (short.sum() + long.sum()), k, uplift)
+
+    made, att, dewmade, dewatt = previous
+    return np.array(prior, dtype=np.float64) + [made, att - made, dewmade, dewatt - dewmade]
+
+# Make probabilities at the rack spots for one player as of a contest, from a model trained on their earlier shots
+def get_log_reg_params(shots, k):
+    from logistic_regression import make_pipeline, get_location_features, pipeline_config, RACK_LOCATIONS
+
+    if shots is None or len(shots) < MIN_SHOTS or shots["SHOT_MADE_FLAG"].nunique() < 2:
+        return None
+    pipeline = make_pipeline()
+    pipeline.fit(shots[pipeline_config["features"]], shots["SHOT_MADE_FLAG"])
+    x, y = np.array(RACK_LOCATIONS).T
+    return pipeline.predict_proba(get_location_features(x, y))[:, 1] * k
+
+# Runs in a worker process: one player's round score distribution as of a contest, or None if the model can't be built
+def run_job(config, playerid, date, previous, money_rack):
+    from simulate import get_pmf_from_params, get_money_balls
+
+    all_shots = get_shots(playerid)
+    shots = get_shots_before(all_shots, date)
+    if config["model"] == "bayesian":
+        params = get_bayesian_params(shots, previous, config["k"], config["uplift"], get_attempt_scale(playerid, all_shots))
+    else:
+        params = get_log_reg_params(shots, config["k"])
+    if params is None:
+        return None
+    return get_pmf_from_params(params, config["model"], get_money_balls(money_rack)).tolist()
+
+def get_jobs(contests, configs, cache, refresh=False):
+    '''
+    The (config, playerid, date, previous contest totals, money rack) of every score distribution that isn't cached yet,
+    with the cache entries they belong in.
+    '''
+    jobs = []
+    keys = []
+    totals = dict()
+    for contest in contests:
+        for player in contest["players"]:
+            playerid = str(player["playerid"])
+            previous = totals.get(playerid, (0, 0, 0, 0))
+            for config in configs:
+                config_key = get_config_key(config)
+                key = f"{contest['date']}/{playerid}"
+                if refresh or key not in cache.get(config_key, {}):
+                    jobs.append((config, playerid, contest["date"], previous, player.get("money_rack", 4)))
+                    keys.append((config_key, key))
+        # Only added once the whole contest is done, so nobody's forecast sees this contest's results
+        for player in contest["players"]:
+            playerid = str(player["playerid"])
+            shooting = [player.get(column) or 0 for column in ["made", "att", "dewmade", "dewatt"]]
+            totals[playerid] = tuple(int(x) + int(y) for x, y in zip(totals.get(playerid, (0, 0, 0, 0)), shooting))
+    return jobs, keys
+
+@instrumented("backtest")
+def backtest(configs, contests=None, workers=None, refresh=False, bins=10):
+    '''
+    Forecast every past contest with each model config (e.g. {"model": "bayesian", "k": 0.3}, see get_config),
+    and score the forecasts. Score distributions are taken from the cache unless refresh is set.
+    Returns a list with one report per config, see evaluate.
+    '''
+    from shot_charts import ingest_shot_charts, has_shot_chart, convert_json_shot_charts
+    from boxscore_store import get_store
+
+    if contests is None:
+        contests = load_contest_history()
+    configs = [get_config(config) for config in configs]
+    cache = load_cache()
+    jobs, keys = get_jobs(contests, configs, cache, refresh)
+    count("backtest", cache_hit=sum(len(contest["players"]) for contest in contests) * len(configs) - len(jobs), cache_miss=len(jobs))
+
+    if jobs:
+        # Make sure shot charts are downloaded before starting the pool, so the downloads share one rate limiter
+        playerids = sorted({job[1] for job in jobs})
+        convert_json_shot_charts(playerids)
+        missing = [playerid for playerid in playerids if not has_shot_chart(playerid)]
+        if missing:
+            ingest_shot_charts(missing)
+        # Likewise the boxscores, which the bayesian priors are scaled by
+        if any(job[0]["model"] == "bayesian" for job in jobs):
+            get_store()
+
+        if workers == 1:
+            pmfs = [run_job(*job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                pmfs = list(executor.map(run_job, *zip(*jobs)))
+        for (config_key, key), pmf in zip(keys, pmfs):
+            cache.setdefault(config_key, dict())[key] = pmf
+        save_cache(cache)
+
+    return [evaluate(contests, config, cache[get_config_key(config)], bins) for config in configs]
+
+def calibration_curve(probs, outcomes, bins=10):
+    '''
+    Forecasts grouped into equal-width probability bins. For each bin with any forecasts in it, gives the
+    mean forecast probability and how often the event happened, which match for a calibrated model.
+    '''
+    probs = np.asarray(probs, dtype=np.float64)
+    outcomes = np.asarray(outcomes, dtype=np.float64)
+    index = np.minimum((probs * bins).astype(int), bins - 1)
+    curve = []
+    for i in range(bins):
+        rows = index == i
+        if rows.any():
+            curve.append({"low": i / bins, "high": (i + 1) / bins, "predicted": float(probs[rows].mean()),
+                          "observed": float(outcomes[rows].mean()), "count": int(rows.sum())})
+    return curve
+
+# Brier score (summed over the outcomes) and log loss of forecasts with one row of outcome probabilities each
+def get_scores(probs, outcomes):
+    rows = np.arange(len(outcomes))
+    actual = np.zeros_like(probs)
+    actual[rows, outcomes] = 1
+    return {"brier": float(((probs - actual) ** 2).sum(axis=1).mean()),
+            "log_loss": float(-np.log(np.maximum(probs[rows, outcomes], EPSILON)).mean())}
+
+# The first date with shot charts to build the models from, the start of the first shot chart season
+def get_shot_chart_start():
+    from shot_charts import seasons
+    return f"{seasons[0][:4]}-10-01"
+
+def evaluate(contests, config, pmfs, bins=10):
+    '''
+    Score one config's forecasts of every contest from the first shot chart season on, with the contests before it
+    scored the same way under "before_shot_charts".
+    '''
+    start = get_shot_chart_start()
+    report = {"config": config, **score_contests([contest for contest in contests if contest["date"] >= start], pmfs, bins)}
+    report["before_shot_charts"] = score_contests([contest for contest in contests if contest["date"] < start], pmfs, bins)
+    return report
+
+def score_contests(contests, pmfs, bins=10):
+    '''
+    "round" scores the first round score distributions. Its calibration curve is of every P(score >= s) forecast.
+    "win" scores the win probabilities of the contests where every player's model could be built.
+    '''
+    from simulate import exact_contest_probs, get_exact_format, CONTEST_FORMAT
+
+    round_pmfs, round_scores = [], []
+    win_probs, winners = [], []
+    for contest in contests:
+        field = [pmfs.get(f"{contest['date']}/{player['playerid']}") for player in contest["players"]]
+        for player, pmf in zip(contest["players"], field):
+            if pmf is not None and player.get("scores"):
+                round_pmfs.append(pmf)
+                round_scores.append(player["scores"][0])
+
+        if contest.get("winner") is not None and all(pmf is not None for pmf in field):
+            field = [np.array(pmf) for pmf in field]
+            probs = exact_contest_probs(field, *get_exact_format(contest.get("format", CONTEST_FORMAT), len(field)))
+            win_probs.append(probs)
+            winners.append([str(player["playerid"]) for player in contest["players"]].index(str(contest["winner"])))
+
+    report = {"round": {"count": len(round_scores)}, "win": {"count": len(winners)}}
+    if round_scores:
+        round_pmfs = np.array(round_pmfs)
+        round_scores = np.array(round_scores)
+        # P(score >= s) for s = 1 to 40
+        exceed = 1 - np.cumsum(round_pmfs, axis=1)[:, :-1]
+        report["round"].update(get_scores(round_pmfs, round_scores))
+        report["round"]["mean_predicted"] = float((round_pmfs @ np.arange(round_pmfs.shape[1])).mean())
+        report["round"]["mean_actual"] = float(round_scores.mean())
+        report["round"]["calibration"] = calibration_curve(exceed.ravel(), (round_scores[:, None] >= np.arange(1, round_pmfs.shape[1])).ravel(), bins)
+    if winners:
+        report["win"].update(get_scores(np.array([np.pad(probs, (0, max(map(len, win_probs)) - len(probs))) for probs in win_probs]), np.array(winners)))
+        report["win"]["calibration"] = calibration_curve(np.concatenate(win_probs), np.concatenate([np.arange(len(probs)) == winner for probs, winner in zip(win_probs, winners)]), bins)
+    return report
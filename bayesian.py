@@ -1,33 +1,77 @@
 import json
 import os
-from data_collection import load_results, load_3ptfg_last_100, load_shot_distance_data
-import scipy.stats
+import warnings
+from data_collection import load_results, load_3ptfg_last_100, load_shot_distance_data, get_shot_location_table, get_registry, shot_location_columns
+from boxscore_store import get_store as get_boxscore_store
+import numpy as np
+from instrumentation import instrumented, count, file_size
 
-def get_3ptfg_last_100(playerid):
-    if not os.path.exists("data/3ptfg_last_100.json"):
-        with open("data/3ptfg_last_100.json", "w") as f:
-            json.dump({}, f)
+# JSON files read once per process: path -> (fingerprint, data). A file is read again only if something else changes it.
+json_caches = dict()
 
-    with open("data/3ptfg_last_100.json", "r") as f:
-        data = json.load(f)
+def get_file_fingerprint(path):
+    try:
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        return None
 
-    if str(playerid) in data.keys():
-        return data[str(playerid)]
+def read_json_cache(path, stage):
+    fingerprint = get_file_fingerprint(path)
+    cached = json_caches.get(path)
+    if cached is None or cached[0] != fingerprint:
+        data = dict()
+        if fingerprint is not None:
+            with open(path, "r") as f:
+                data = json.load(f)
+            count(stage, bytes_read=file_size(path))
+        cached = json_caches[path] = (fingerprint, data)
+    return cached[1]
 
-    return load_3ptfg_last_100(playerid)
+# Add an entry that the loader has just written to the file, without reading it all again
+def add_to_json_cache(path, key, value):
+    data = json_caches[path][1]
+    data[key] = value
+    json_caches[path] = (get_file_fingerprint(path), data)
 
-def get_shot_distance_data(playerid):
-    if not os.path.exists("data/shot_pc_by_dist.json"):
-        with open("data/shot_pc_by_dist.json", "w") as f:
-            json.dump({}, f)
+@instrumented("bayesian.get_3ptfg_last_100")
+def get_3ptfg_last_100(playerid):
+    data = read_json_cache("data/3ptfg_last_100.json", "bayesian.get_3ptfg_last_100")
+    if str(playerid) in data:
+        count("bayesian.get_3ptfg_last_100", cache_hit=1)
+        return data[str(playerid)]
 
-    with open("data/shot_pc_by_dist.json", "r") as f:
-        data = json.load(f)
+    count("bayesian.get_3ptfg_last_100", cache_miss=1)
+    # Summed from the boxscore store, and written to the file for next time if the player is in it
+    last_100 = load_3ptfg_last_100(playerid)
+    if get_boxscore_store().has_player(playerid):
+        add_to_json_cache("data/3ptfg_last_100.json", str(playerid), last_100)
+    return last_100
 
-    if str(playerid) in data.keys():
+@instrumented("bayesian.get_shot_distance_data")
+def get_shot_distance_data(playerid):
+    data = read_json_cache("data/shot_pc_by_dist.json", "bayesian.get_shot_distance_data")
+    if str(playerid) in data:
+        count("bayesian.get_shot_distance_data", cache_hit=1)
         return data[str(playerid)]
 
-    return load_shot_distance_data(playerid)
+    count("bayesian.get_shot_distance_data", cache_miss=1)
+    # Looked up in the league shot location table, and written to the file for next time
+    shot_distance_data = load_shot_distance_data(playerid)
+    add_to_json_cache("data/shot_pc_by_dist.json", str(playerid), shot_distance_data)
+    return shot_distance_data
+
+# Since we want shots from historical 3pt contests to count for more than in-game shots, we need a scale factor k.
+# fit_priors estimates k from the contest history, and until it has been run this hand-picked value is used.
+PRIOR_WEIGHT = 0.5
+# Prior for players with no shooting data to build one from, until fit_priors replaces it with a fitted league-level prior
+FALLBACK_PRIOR = (3, 7, 1, 4)
+# Written by fit_priors: the fitted settings and every player's posterior
+POSTERIOR_TABLE = "data/bayesian_posteriors.npz"
+# Points on the normal scale, out to this many standard deviations, where the Beta inverse CDF is evaluated exactly
+# and interpolated between. Uniforms further out than the grid are inverted exactly.
+QUANTILE_GRID_SIZE = 513
+QUANTILE_GRID_LIMIT = 6
 
 '''
 Use a beta prior distribution with averages corresponding to the player's average percentages.
@@ -35,56 +79,73 @@ Intuition for the priors: "If a player took 500 threes in the last 100 games,
 and 40% of them were from 25-29 ft, then let's use 500, scaled down, to construct a pseudo-count prior.
 For the dew balls, only use those 40% of long threes."
 '''
-def get_priors(playerid):
+@instrumented("bayesian.get_priors")
+def get_priors(playerid, k=None):
+    settings = get_prior_settings()
+    if k is None:
+        k = settings["k"]
     last_100_data = get_3ptfg_last_100(int(playerid)) # made, att, 3pt%
     shot_distance_data = get_shot_distance_data(int(playerid)) # fgm_20-24, fga_20-24, fg_pc_20-24, fgm_25-29, fga_25-29, fg_pc_25-29
 
-    epsilon = 0.001 # To avoid 0s in extreme cases
-
-    k = 0.5 # Since we want shots from historical 3pt contests to count for more than in-game shots, we need a scale factor k.
-
-    # Avoid division by zero errors, give low percentages for low volume shooters 
-    if (shot_distance_data["fga_20-24"] + shot_distance_data["fga_25-29"]) == 0:
-        return (3, 7, 1, 4)
+    # Avoid division by zero errors. Players with no in-game threes to build a prior from get the fallback prior, as in fit_priors.
+    if (shot_distance_data["fga_20-24"] + shot_distance_data["fga_25-29"]) == 0 or last_100_data["att"] == 0:
+        return settings["fallback"]
     
     pc_long_threes = shot_distance_data["fga_25-29"] / (shot_distance_data["fga_20-24"] + shot_distance_data["fga_25-29"])
+    return get_prior_params(shot_distance_data["fg_pc_20-24"], shot_distance_data["fg_pc_25-29"], last_100_data["att"], pc_long_threes, k, settings["uplift"])
+
+# Beta prior parameters from in-game shooting, for one player or as arrays over many.
+# uplift scales the in-game percentages up to what players shoot in the contest, from an uncontested rack.
+def get_prior_params(pc_reg, pc_dew, att, pc_long_threes, k, uplift=1.0):
+    epsilon = 0.001 # To avoid 0s in extreme cases
+    pc_reg = np.minimum(pc_reg * uplift, 1)
+    pc_dew = np.minimum(pc_dew * uplift, 1)
 
     # alpha prior represents assumed number of makes in the data
-    alpha_reg_prior = shot_distance_data["fg_pc_20-24"] * last_100_data["att"] * k + epsilon
+    alpha_reg_prior = pc_reg * att * k + epsilon
     # beta prior represents assumed number of misses in the data
-    beta_reg_prior = (1-shot_distance_data["fg_pc_20-24"]) * last_100_data["att"] * k + epsilon
+    beta_reg_prior = (1-pc_reg) * att * k + epsilon
 
     # Prior distribution for dew shots
-    alpha_dew_prior = shot_distance_data["fg_pc_25-29"] * last_100_data["att"] * pc_long_threes * k + epsilon
-    beta_dew_prior = (1-shot_distance_data["fg_pc_25-29"]) * last_100_data["att"] * pc_long_threes * k + epsilon
+    alpha_dew_prior = pc_dew * att * pc_long_threes * k + epsilon
+    beta_dew_prior = (1-pc_dew) * att * pc_long_threes * k + epsilon
 
     return (alpha_reg_prior, beta_reg_prior, alpha_dew_prior, beta_dew_prior)
 
-# Get previous contest data
+# Get previous contest data: made, att, dewmade, dewatt, or zeros for a player with no contest history
 def get_results(playerid):
-    try:
-        f = open("data/results.json")
-    except FileNotFoundError:
-        load_results()
-        f = open("data/results.json")
+    return get_results_table().get(str(playerid), (0, 0, 0, 0))
 
-    results = json.load(f)
-    f.close()
+# (fingerprint, table) for results.json, built once per process and again whenever the file changes
+results_table = None
 
-    for player in results:
-        if player["id"] == str(playerid):
-            made = player["made"]
-            att = player["att"]
-            dewmade = player["dewmade"]
-            dewatt = player["dewatt"]
+# Every player's contest totals, by playerid. Players from before the dew balls have null dew counts, counted as 0.
+@instrumented("bayesian.get_results")
+def get_results_table():
+    global results_table
+    if not os.path.exists("data/results.json"):
+        load_results()
+    fingerprint = get_file_fingerprint("data/results.json")
+    if results_table is None or results_table[0] != fingerprint:
+        with open("data/results.json", "r") as f:
+            results = json.load(f)
+        count("bayesian.get_results", bytes_read=file_size("data/results.json"))
+        results_table = (fingerprint, {player["id"]: tuple(int(player[key] or 0) for key in ["made", "att", "dewmade", "dewatt"]) for player in results})
+    return results_table[1]
 
-            return int(made), int(att), int(dewmade), int(dewatt)
-    
-    return
+# Perform Bayesian updating of the shot percentage distribution based on previous contest data.
+# With the fitted prior weight (k=None), the posterior is looked up in the table written by fit_priors if the player is in it
+# and the data it was fitted to hasn't changed since.
+def update(playerid, k=None):
+    table = get_posterior_table()
+    if k is None or k == table["k"]:
+        posterior = table["posteriors"].get(str(playerid))
+        if posterior is not None:
+            count("bayesian.update", cache_hit=1)
+            return posterior
+        count("bayesian.update", cache_miss=1)
 
-# Perform Bayesian updating of the shot percentage distribution based on previous contest data
-def update(playerid):
-    (alpha_reg_prior, beta_reg_prior, alpha_dew_prior, beta_dew_prior) = get_priors(playerid)
+    (alpha_reg_prior, beta_reg_prior, alpha_dew_prior, beta_dew_prior) = get_priors(playerid, k)
     (made, att, dewmade, dewatt) = get_results(playerid)
     alpha_reg_post = alpha_reg_prior + made
     beta_reg_post = beta_reg_prior + (att - made)
@@ -93,11 +154,165 @@ def update(playerid):
 
     return (alpha_reg_post, beta_reg_post, alpha_dew_post, beta_dew_post)
 
-def get_probabilities(n, playerid):
-    (alpha_reg, beta_reg, alpha_dew, beta_dew) = update(playerid)
-    theta_reg_dist = scipy.stats.beta(alpha_reg, beta_reg)
-    theta_dew_dist = scipy.stats.beta(alpha_dew, beta_dew)
-    samples_reg = theta_reg_dist.rvs(n)
-    samples_dew = theta_dew_dist.rvs(n)
+def get_probabilities(n, playerid, rng=None):
+    return sample_probabilities(n, update(playerid), rng)
+
+# Draw n realisations of theta_reg and theta_dew from the given posterior parameters.
+# If an (n, 2) array of uniforms is given (e.g. antithetic or Sobol points), they are transformed by the inverse CDF instead.
+@instrumented("bayesian.sample_probabilities")
+def sample_probabilities(n, posterior, rng=None, uniforms=None):
+    (alpha_reg, beta_reg, alpha_dew, beta_dew) = posterior
+    if uniforms is not None:
+        return beta_inverse_cdf(alpha_reg, beta_reg, uniforms[:, 0]), beta_inverse_cdf(alpha_dew, beta_dew, uniforms[:, 1])
+
+    if rng is None:
+        rng = np.random.default_rng()
+    samples_reg = rng.beta(alpha_reg, beta_reg, n)
+    samples_dew = rng.beta(alpha_dew, beta_dew, n)
+
+    return samples_reg, samples_dew
+# The Beta inverse CDF at each of the uniforms u. For more uniforms than the grid has points, betaincinv is only
+# evaluated on the grid and interpolated on the normal scale, where a Beta's quantiles are close to linear.
+# This is about 8x faster, and within 2e-5 of the exact quantile even for the fallback prior.
+def beta_inverse_cdf(alpha, beta, u):
+    import scipy.special
+
+    if len(u) <= QUANTILE_GRID_SIZE:
+        return scipy.special.betaincinv(alpha, beta, u)
+    grid = np.linspace(-QUANTILE_GRID_LIMIT, QUANTILE_GRID_LIMIT, QUANTILE_GRID_SIZE)
+    z = scipy.special.ndtri(u)
+    samples = np.interp(z, grid, scipy.special.betaincinv(alpha, beta, scipy.special.ndtr(grid)))
+    tails = np.abs(z) > QUANTILE_GRID_LIMIT
+    if tails.any():
+        samples[tails] = scipy.special.betaincinv(alpha, beta, u[tails])
+    return samples
+
+# Data files the posteriors are built from, by fit_priors or by get_priors and get_results for a single player
+def get_posterior_inputs(season):
+    from boxscore_store import get_source_path
+    return ["data/results.json", "data/3ptfg_last_100.json", "data/shot_pc_by_dist.json", f"data/shot_locations/{season}.npz", get_source_path()]
+
+def get_inputs_fingerprint(paths):
+    return [[path, *(get_file_fingerprint(path) or (None, None))] for path in paths if path is not None]
+
+# Settings and posteriors from POSTERIOR_TABLE, loaded once per process and again whenever fit_priors rewrites it
+posterior_table = None
+
+def get_posterior_table():
+    global posterior_table
+    fingerprint = get_file_fingerprint(POSTERIOR_TABLE)
+
+    if posterior_table is None or posterior_table["fingerprint"] != fingerprint:
+        if fingerprint is None:
+            posterior_table = {"fingerprint": None, "k": PRIOR_WEIGHT, "uplift": 1.0, "fallback": FALLBACK_PRIOR, "posteriors": dict(),
+                               "table_posteriors": dict(), "inputs": []}
+        else:
+            with np.load(POSTERIOR_TABLE) as data:
+                posteriors = dict(zip(data["playerid"].astype(str), map(tuple, data["posterior"].tolist())))
+                # Tables from before the inputs were recorded count as out of date
+                inputs = json.loads(str(data["inputs"])) if "inputs" in data else None
+                posterior_table = {"fingerprint": fingerprint, "k": float(data["k"]), "uplift": float(data["uplift"]),
+                                   "fallback": tuple(data["fallback"].tolist()), "posteriors": posteriors,
+                                   "table_posteriors": posteriors, "inputs": inputs}
+            count("bayesian.get_posterior_table", bytes_read=file_size(POSTERIOR_TABLE))
+
+    # If the data has changed since fit_priors ran, the stored posteriors are out of date, so every player's is computed afresh.
+    # The fitted settings are kept, as the best estimate until fit_priors is run again.
+    if posterior_table["fingerprint"] is not None:
+        inputs = posterior_table["inputs"]
+        current = inputs is not None and get_inputs_fingerprint([path for path, _, _ in inputs]) == inputs
+        if not current and posterior_table["posteriors"]:
+            warnings.warn(f"The data has changed since {POSTERIOR_TABLE} was written, so its posteriors are ignored. Run fit_priors again to update them.")
+        posterior_table["posteriors"] = posterior_table["table_posteriors"] if current else dict()
+    return posterior_table
+
+# The prior weight k, contest uplift and fallback prior: fitted by fit_priors, or the defaults if it hasn't been run
+def get_prior_settings():
+    table = get_posterior_table()
+    return {"k": table["k"], "uplift": table["uplift"], "fallback": table["fallback"]}
+
+# Log-likelihood of made out of att under a beta-binomial, leaving out the binomial coefficient (which doesn't depend on alpha and beta)
+def beta_binomial_loglik(made, att, alpha, beta):
+    import scipy.special
+    return scipy.special.betaln(alpha + made, beta + att - made) - scipy.special.betaln(alpha, beta)
+
+# 20-24ft and 25-29ft shooting for each player from the league shot location table, as arrays with NaN for players not in it
+def get_distance_splits(playerids, season="2024-25"):
+    table = get_shot_location_table(season)
+    registry = get_registry()
+    splits = {key: np.full(len(playerids), np.nan) for key in shot_location_columns}
+    for i, playerid in enumerate(playerids):
+        nba_id = registry.get_nba_id(playerid)
+        row = table["by_id"].get(nba_id) if nba_id is not None else None
+        if row is None:
+            row = table["by_name"].get(registry.get_name(playerid))
+        if row is not None:
+            for key in shot_location_columns:
+                splits[key][i] = row[key]
+    return splits
+
+@instrumented("bayesian.fit_priors")
+def fit_priors(season="2024-25"):
+    '''
+    Batch job that fits the prior to the contest history, and writes every player's posterior to POSTERIOR_TABLE for update() to read.
+    In-game aggregates (threes attempted over the last 100 games, and the 20-24ft/25-29ft split) are computed for every
+    player in the boxscores at once. The prior weight k and the contest uplift are fitted by beta-binomial maximum
+    likelihood of every contest shooter's results given their prior, and the fallback prior for players without
+    in-game data by beta-binomial maximum likelihood of the contest results alone.
+    Returns the fitted settings.
+    '''
+    import scipy.optimize
+    from boxscore_store import get_store
+
+    store = get_store()
+    results = get_results_table()
+    # Everyone in the boxscores, and past contestants who no longer play
+    playerids = sorted(set(store.player_ids.astype(str)) | set(results), key=int)
+    att = np.zeros(len(playerids))
+    in_store = np.isin(np.array(playerids, dtype=np.int64), store.player_ids)
+    att[in_store] = store.get_last_n_totals("threepointersattempted")[np.searchsorted(store.player_ids, np.array(playerids, dtype=np.int64)[in_store])]
+
+    splits = get_distance_splits(playerids, season)
+    fga = splits["fga_20-24"] + splits["fga_25-29"]
+    # NaN (not in the table) compares False, so those players get the fallback prior too
+    has_prior = (fga > 0) & (att > 0)
+    pc_long_threes = np.divide(splits["fga_25-29"], fga, out=np.zeros(len(fga)), where=has_prior)
+    made, att_contest, dewmade, dewatt = np.array([results.get(playerid, (0, 0, 0, 0)) for playerid in playerids], dtype=np.float64).T
+
+    def neg_loglik(x, rows):
+        k, uplift = np.exp(x)
+        alpha_reg, beta_reg, alpha_dew, beta_dew = get_prior_params(splits["fg_pc_20-24"][rows], splits["fg_pc_25-29"][rows], att[rows], pc_long_threes[rows], k, uplift)
+        return -(beta_binomial_loglik(made[rows], att_contest[rows], alpha_reg, beta_reg).sum() +
+                 beta_binomial_loglik(dewmade[rows], dewatt[rows], alpha_dew, beta_dew).sum())
+
+    fitted = has_prior & (att_contest + dewatt > 0)
+    if not fitted.any():
+        raise ValueError("No players with both contest history and in-game shooting data to fit the prior to")
+    # Searched on a log scale, with k between 0.001 and 10 and the uplift between 0.5 and 3
+    fit = scipy.optimize.minimize(neg_loglik, np.log([PRIOR_WEIGHT, 1.0]), args=(fitted,), method="L-BFGS-B",
+                                  bounds=[np.log([0.001, 10]), np.log([0.5, 3])])
+    k, uplift = np.exp(fit.x)
+
+    def neg_loglik_league(x, made, att):
+        alpha, beta = np.exp(x)
+        return -beta_binomial_loglik(made, att, alpha, beta).sum()
+
+    # League-level Beta for regular and dew balls, with pseudo-counts between 0.1 and 500
+    fallback = []
+    for shots_made, shots in [(made, att_contest), (dewmade, dewatt)]:
+        rows = shots > 0
+        league = scipy.optimize.minimize(neg_loglik_league, np.log([1.0, 1.0]), args=(shots_made[rows], shots[rows]), method="L-BFGS-B",
+                                         bounds=[np.log([0.1, 500])] * 2)
+        fallback.extend(np.exp(league.x))
+
+    priors = np.column_stack(get_prior_params(splits["fg_pc_20-24"], splits["fg_pc_25-29"], att, pc_long_threes, k, uplift))
+    priors = np.where(has_prior[:, None], priors, fallback)
+    posteriors = priors + np.column_stack([made, att_contest - made, dewmade, dewatt - dewmade])
+    inputs = get_inputs_fingerprint(get_posterior_inputs(season))
 
-    return samples_reg, samples_dew
\ No newline at end of file
+    with open(POSTERIOR_TABLE + ".tmp", "wb") as f:
+        np.savez(f, playerid=np.array(playerids, dtype=np.int64), posterior=posteriors, k=k, uplift=uplift, fallback=np.array(fallback),
+                 loglik=-fit.fun, num_fitted=fitted.sum(), inputs=json.dumps(inputs))
+    os.replace(POSTERIOR_TABLE + ".tmp", POSTERIOR_TABLE)
+    return {"k": float(k), "uplift": float(uplift), "fallback": tuple(float(x) for x in fallback), "loglik": float(-fit.fun),
+            "num_fitted": int(fitted.sum()), "num_players": len(playerids)}
@@ -0,0 +1,243 @@
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+'''
+Benchmarks for the simulation and modelling hot paths, run offline against synthetic data.
+A fixture directory with players, boxscores, contest results and shot charts is generated first, and every stage
+then runs inside it, so nothing touches the network or the real data/ directory.
+
+    python benchmark.py --players 8 --n 100000
+    python benchmark.py --save-baseline           # store the results as the baseline
+    python benchmark.py --baseline benchmark_baseline.json   # flag stages slower than the baseline
+'''
+
+seasons = ["2021-22", "2022-23", "2023-24", "2024-25"]
+
+first_names = ["Jalen", "Cade", "Darius", "Tyler", "Buddy", "Cameron", "Damian", "Norman", "Stephen", "Klay", "Devin", "Trae"]
+surnames = ["Brunson", "Cunningham", "Garland", "Herro", "Hield", "Johnson", "Lillard", "Powell", "Curry", "Thompson", "Booker", "Young"]
+
+def write_json(path, data):
+    with open(path, "w") as f:
+        json.dump(data, f)
+
+def make_fixtures(path, num_players=8, num_other_players=500, games=120, shots_per_season=250, seed=0):
+    '''
+    Write synthetic but realistic data files to path/data, in the formats the data collection code produces.
+    num_players are contest participants with full data, and num_other_players only appear in players.json and the boxscores.
+    Returns the participants' playerids.
+    '''
+    from api_client import write_json_list
+    from shot_charts import write_season
+    from logistic_regression import get_shot_zone_area
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(f"{path}/data/models", exist_ok=True)
+
+    players = []
+    for i in range(num_players + num_other_players):
+        players.append({"row": str(i), "playerid": str(i + 1),
+                        "firstname": first_names[i % len(first_names)], "surname": f"{surnames[i % len(surnames)]}{i // len(surnames) or ''}",
+                        "height": "76", "weight": "200", "dob": "1/1/1995", "position": "SG", "team": "",
+                        "yeardrafted": "2017", "rounddrafted": "1", "overallpickdrafted": "10"})
+    participants = players[:num_players]
+    ids = [player["playerid"] for player in participants]
+    write_json(f"{path}/data/players.json", players)
+    write_json(f"{path}/data/participants.json", participants)
+
+    # Each player has a true three point percentage, which the boxscores, results and shot charts are drawn from
+    skill = {player["playerid"]: rng.uniform(0.33, 0.43) for player in players}
+
+    with open(f"{path}/data/boxscores.ndjson", "w") as f:
+        for player in players:
+            attempts = rng.poisson(6, games)
+            makes = rng.binomial(attempts, skill[player["playerid"]])
+            for made, att in zip(makes, attempts):
+                f.write(json.dumps({"player": player["playerid"], "threepointers": str(made), "threepointersattempted": str(att)}) + "\n")
+    # As a finished download leaves them
+    write_json_list(f"{path}/data/boxscores.ndjson", f"{path}/data/boxscores.json")
+
+    results = []
+    shot_pc_by_dist = dict()
+    for playerid in ids:
+        att = int(rng.integers(25, 200))
+        dewatt = int(rng.integers(2, 8))
+        results.append({"name": "", "id": playerid, "made": str(rng.binomial(att, skill[playerid] * 1.25)), "att": str(att),
+                        "dewmade": str(rng.binomial(dewatt, skill[playerid])), "dewatt": str(dewatt), "year": ""})
+        fga_short, fga_long = rng.uniform(1, 3), rng.uniform(3, 8)
+        shot_pc_by_dist[playerid] = {"fgm_20-24": round(fga_short * skill[playerid], 1), "fga_20-24": round(fga_short, 1), "fg_pc_20-24": round(skill[playerid] + 0.02, 3),
+                                     "fgm_25-29": round(fga_long * skill[playerid], 1), "fga_25-29": round(fga_long, 1), "fg_pc_25-29": round(skill[playerid], 3)}
+    write_json(f"{path}/data/results.json", results)
+    write_json(f"{path}/data/shot_pc_by_dist.json", shot_pc_by_dist)
+
+    # Jump shots spread around the arc, getting harder with distance
+    for playerid in ids:
+        for s, season in enumerate(seasons):
+            angle = rng.uniform(0, np.pi, shots_per_season)
+            distance = rng.gamma(20, 0.25, shots_per_season) + 232
+            x = np.round(distance * np.cos(angle)).astype(int)
+            y = np.maximum(np.round(distance * np.sin(angle)).astype(int), -40)
+            feet = np.floor(np.hypot(x, y) / 10).astype(int)
+            made = rng.random(shots_per_season) < np.clip(skill[playerid] - 0.015 * (feet - 24), 0.05, 0.9)
+            write_season({"GAME_ID": [f"002{21 + s}{i // 10:05d}" for i in range(shots_per_season)],
+                          "GAME_DATE": [int(f"20{21 + s}1101") + i // 10 for i in range(shots_per_season)],
+                          "LOC_X": x, "LOC_Y": y, "SHOT_DISTANCE": feet, "SHOT_MADE_FLAG": made.astype(int),
+                          "SHOT_ZONE_AREA": get_shot_zone_area(x, y), "SHOT_TYPE": "3PT Field Goal", "ACTION_TYPE": "Jump Shot"},
+                         f"{path}/data/shot_charts/{playerid}/{season}.npz")
+
+    # Past contests for the backtests, during each season after the first. Everyone shoots a round and the top three shoot the final.
+    weights = np.ones(27, dtype=np.int64)
+    weights[[4, 9, 15, 21, 22, 23, 24, 25, 26]] = 2
+    weights[[10, 16]] = 3
+    contests = []
+    for s in range(1, len(seasons)):
+        players = {playerid: {"playerid": playerid, "scores": [], "shots": [], "made": 0, "att": 0, "dewmade": 0, "dewatt": 0} for playerid in ids}
+        field = ids
+        for num_advance in [3, 1]:
+            for playerid in field:
+                makes = rng.random(27) < skill[playerid] * 1.25
+                player = players[playerid]
+                player["scores"].append(int(makes @ weights))
+                player["shots"].append(makes.astype(int).tolist())
+                player["made"] += int(makes.sum() - makes[[10, 16]].sum())
+                player["att"] += 25
+                player["dewmade"] += int(makes[[10, 16]].sum())
+                player["dewatt"] += 2
+            field = sorted(field, key=lambda playerid: -players[playerid]["scores"][-1])[:num_advance]
+        contests.append({"date": f"20{22 + s}-02-17", "players": list(players.values()), "winner": field[0]})
+    write_json(f"{path}/data/contest_history.json", contests)
+    return ids
+
+def measure(fn, repeats, items):
+    '''
+    Time repeats calls of fn, then run it once more under tracemalloc for the peak memory.
+    items is how many rounds/contests/players one call processes, for the throughput.
+    '''
+    fn()  # Warm up caches and imports, so the timings are of the steady state
+    times = []
+    for _ in range(repeats):
+        gc.collect()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    times = np.array(times)
+    return {"p50": float(np.percentile(times, 50)),
+            "p90": float(np.percentile(times, 90)),
+            "p99": float(np.percentile(times, 99)),
+            "throughput": items / float(np.percentile(times, 50)),
+            "peak_mb": peak / 2**20}
+
+def get_stages(ids, n, n_contests, n_slow):
+    import simulate
+    import bayesian
+    import logistic_regression
+    import shot_sequence
+    from data_collection import load_3ptfg_last_100_many
+
+    thetas = simulate.get_thetas(simulate.get_params(ids[0], "bayesian"), "bayesian", 1, [10, 16])[0]
+    rng = np.random.default_rng(0)
+    money_balls = [4, 9, 15, 21, 22, 23, 24, 25, 26]
+    shot_sequence.fit_sequence_model()
+
+    # (name, function, items per call, unit)
+    return [
+        ("load_3ptfg_last_100", lambda: load_3ptfg_last_100_many(ids), len(ids), "players"),
+        ("bayesian.get_priors", lambda: [bayesian.get_priors(id) for id in ids], len(ids), "players"),
+        ("bayesian.get_probabilities", lambda: bayesian.get_probabilities(n, ids[0], rng), n, "draws"),
+        ("logistic_regression.train", lambda: logistic_regression.train(ids[0]), 1, "models"),
+        ("get_probabilities_by_location", lambda: logistic_regression.get_probabilities_by_location_many(ids), len(ids), "players"),
+        ("sim_round", lambda: [simulate.sim_round(thetas, False, money_balls, [10, 16], rng) for _ in range(n_slow)], n_slow, "rounds"),
+        ("simulate[bayesian]", lambda: simulate.simulate(ids[0], "bayesian", n), n, "rounds"),
+        ("simulate[log_reg]", lambda: simulate.simulate(ids[0], "log_reg", n), n, "rounds"),
+        ("simulate[bayesian,sequential]", lambda: simulate.simulate(ids[0], "bayesian", n, sequential=True), n, "rounds"),
+        ("simulate_contest[bayesian]", lambda: simulate.simulate_contest("bayesian", n_contests), n_contests, "contests"),
+        ("simulate_contest[log_reg]", lambda: simulate.simulate_contest("log_reg", n_contests), n_contests, "contests"),
+    ]
+
+def run(num_players=8, n=100000, n_contests=100000, n_slow=1000, repeats=5, stages=None):
+    '''
+    Generate fixtures in a temporary directory and benchmark every stage (or only those named in stages) inside it.
+    Returns {stage: {"p50", "p90", "p99", "throughput", "unit", "peak_mb"}}, with times in seconds.
+    '''
+    cwd = os.getcwd()
+    path = tempfile.mkdtemp(prefix="contest_benchmark_")
+    results = dict()
+    try:
+        os.chdir(path)
+        ids = make_fixtures(path, num_players)
+        for name, fn, items, unit in get_stages(ids, n, n_contests, n_slow):
+            if stages and name not in stages:
+                continue
+            # simulate_contest prints the odds every call
+            with contextlib.redirect_stdout(io.StringIO()):
+                results[name] = measure(fn, repeats, items)
+            results[name]["unit"] = unit
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(path, ignore_errors=True)
+    return results
+
+# Stages whose median time is more than threshold slower than the baseline's
+def compare(results, baseline, threshold=0.2):
+    regressions = []
+    for name, result in results.items():
+        if name in baseline and result["p50"] > baseline[name]["p50"] * (1 + threshold):
+            regressions.append(name)
+    return regressions
+
+def print_results(results, baseline=None):
+    print(f"{'stage':<32}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'throughput':>22}{'peak MB':>10}{'vs baseline':>13}")
+    for name, result in results.items():
+        change = ""
+        if baseline and name in baseline:
+            change = f"{100 * (result['p50'] / baseline[name]['p50'] - 1):+.1f}%"
+        throughput = f"{result['throughput']:,.0f} {result['unit']}/s"
+        print(f"{name:<32}{1000 * result['p50']:>10.2f}{1000 * result['p90']:>10.2f}{1000 * result['p99']:>10.2f}{throughput:>22}{result['peak_mb']:>10.1f}{change:>13}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the simulation and modelling hot paths on synthetic data.")
+    parser.add_argument("--players", type=int, default=8, help="field size")
+    parser.add_argument("--n", type=int, default=100000, help="rounds per simulate call")
+    parser.add_argument("--contests", type=int, default=100000, help="contests per simulate_contest call")
+    parser.add_argument("--slow-rounds", type=int, default=1000, help="rounds for the one-ball-at-a-time sim_round loop")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--stage", action="append", help="only run this stage (can be repeated)")
+    parser.add_argument("--baseline", default="benchmark_baseline.json", help="baseline to compare against, if it exists")
+    parser.add_argument("--save-baseline", action="store_true", help="save these results as the baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown relative to the baseline that counts as a regression")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = run(args.players, args.n, args.contests, args.slow_rounds, args.repeats, args.stage)
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.output:
+        write_json(args.output, results)
+    if args.save_baseline:
+        write_json(args.baseline, results)
+        print(f"Saved baseline to {args.baseline}")
+    elif baseline:
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"Regressions (more than {100 * args.threshold:.0f}% slower than the baseline): {', '.join(regressions)}")
+            raise SystemExit(1)
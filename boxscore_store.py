@@ -0,0 +1,136 @@
+import json
+import os
+import numpy as np
+from instrumentation import instrumented, count, file_size
+
+'''
+Columnar store for the boxscores dump, so per-player lookups don't need to parse the whole file.
+Each column is an integer .npy array in data/boxscores/, sorted by player with each player's games
+kept in the order of the dump (the order "last n games" has always been taken in).
+offsets[i]:offsets[i+1] is the slice of rows belonging to player_ids[i].
+'''
+
+store_dir = "data/boxscores"
+columns = ["threepointers", "threepointersattempted"]
+
+# Source files in order of preference. The NDJSON is written by the paginated client as pages arrive, and the
+# JSON list is only written from it once the download has finished.
+ndjson_path = "data/boxscores.ndjson"
+json_path = "data/boxscores.json"
+
+# The boxscores to build the store from, or None if no download has finished
+def get_source_path():
+    if is_ndjson_complete():
+        return ndjson_path
+    if os.path.exists(json_path):
+        return json_path
+    return None
+
+def is_ndjson_complete():
+    # While a download is running or was interrupted, its checkpoint is still there and the NDJSON is newer than
+    # the JSON list of the last download to finish
+    if not os.path.exists(ndjson_path) or os.path.exists(ndjson_path + ".checkpoint") or not os.path.exists(json_path):
+        return False
+    return os.stat(ndjson_path).st_mtime_ns <= os.stat(json_path).st_mtime_ns
+
+def get_source_fingerprint(path):
+    stat = os.stat(path)
+    return [path, stat.st_mtime_ns, stat.st_size]
+
+def read_boxscores(path):
+    if path.endswith(".ndjson"):
+        with open(path, "r") as f:
+            for line in f:
+                yield json.loads(line)
+    else:
+        with open(path, "r") as f:
+            yield from json.load(f)
+
+def to_int(value):
+    # Missing values counted as 0, as pd.to_numeric(...).sum() used to skip them
+    if value is None or value == "":
+        return 0
+    return int(float(value))
+
+def build_store(path):
+    players = []
+    values = {column: [] for column in columns}
+    for boxscore in read_boxscores(path):
+        players.append(to_int(boxscore["player"]))
+        for column in columns:
+            values[column].append(to_int(boxscore[column]))
+
+    players = np.array(players, dtype=np.int32)
+    # Stable sort, so each player's games stay in their original order
+    order = np.argsort(players, kind="stable")
+    players = players[order]
+    player_ids, starts = np.unique(players, return_index=True)
+    offsets = np.append(starts, len(players)).astype(np.int64)
+
+    os.makedirs(store_dir, exist_ok=True)
+    np.save(f"{store_dir}/player_ids.npy", player_ids)
+    np.save(f"{store_dir}/offsets.npy", offsets)
+    for column in columns:
+        np.save(f"{store_dir}/{column}.npy", np.array(values[column], dtype=np.int16)[order])
+    with open(f"{store_dir}/source.json", "w") as f:
+        json.dump(get_source_fingerprint(path), f)
+
+class BoxscoreStore:
+    def __init__(self):
+        path = get_source_path()
+        if path is None:
+            # Starts the download, or resumes an interrupted one from its checkpoint
+            from data_collection import load_boxscores
+            load_boxscores()
+            path = get_source_path()
+
+        if self.is_stale(path):
+            count("boxscore_store.open", cache_miss=1, bytes_read=file_size(path))
+            build_store(path)
+        else:
+            count("boxscore_store.open", cache_hit=1)
+
+        self.player_ids = np.load(f"{store_dir}/player_ids.npy")
+        self.offsets = np.load(f"{store_dir}/offsets.npy")
+        self.columns = {column: np.load(f"{store_dir}/{column}.npy", mmap_mode="r") for column in columns}
+
+    def is_stale(self, path):
+        try:
+            with open(f"{store_dir}/source.json", "r") as f:
+                return json.load(f) != get_source_fingerprint(path)
+        except FileNotFoundError:
+            return True
+
+    def has_player(self, playerid):
+        return self.get_slice(playerid).stop > 0
+
+    def get_slice(self, playerid):
+        i = np.searchsorted(self.player_ids, int(playerid))
+        if i == len(self.player_ids) or self.player_ids[i] != int(playerid):
+            return slice(0, 0)
+        return slice(self.offsets[i], self.offsets[i + 1])
+
+    # A player's last n games for the given column
+    def get_last_n(self, playerid, column, n=100):
+        rows = self.get_slice(playerid)
+        return self.columns[column][max(rows.start, rows.stop - n):rows.stop]
+
+    def get_last_n_totals(self, column, n=100):
+        '''
+        Totals of the given column over the last n games of every player at once.
+        Returns the totals in the same order as self.player_ids.
+        '''
+        cumulative = np.concatenate([[0], np.cumsum(self.columns[column], dtype=np.int64)])
+        ends = self.offsets[1:]
+        starts = np.maximum(self.offsets[:-1], ends - n)
+        return cumulative[ends] - cumulative[starts]
+
+store = None
+
+# The store is opened on first use, once per process
+@instrumented("boxscore_store.open")
+def get_store():
+    global store
+    if store is None:
+        store = BoxscoreStore()
+    return store
@@ -0,0 +1,185 @@
+import argparse
+import json
+import sys
+
+'''
+Command line entry point.
+
+    python contest.py simulate --model bayesian --n 100000 --seed 1 --format json
+    python contest.py simulate --players 1050 1314 1372 1632 1815 1854 --advance 4 2 --tie-break previous_round
+    python contest.py player 1050 --model log_reg --n 100000
+    python contest.py player 1050 --exact
+    python contest.py serve --port 8000 --workers 4
+    python contest.py fit-priors
+    python contest.py fit-sequence
+    python contest.py simulate --sequential
+    python contest.py backtest --model bayesian log_reg --workers 4
+
+Nothing heavy is imported until a command runs, so --help and argument errors are instant.
+'''
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog="contest", description="Price the 3pt contest.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    contest = commands.add_parser("simulate", help="win probabilities for the whole field")
+    contest.add_argument("--model", choices=["bayesian", "log_reg"], default="bayesian")
+    contest.add_argument("--n", type=int, default=100000, help="number of contests (the most to run with --tolerance)")
+    contest.add_argument("--exact", action="store_true", help="calculate the probabilities exactly instead of simulating")
+    contest.add_argument("--tolerance", type=float, help="run until every confidence interval is narrower than this")
+    contest.add_argument("--target", choices=["prob", "odds"], default="prob", help="what --tolerance applies to")
+    contest.add_argument("--players", nargs="+", help="playerids of the field (this year's participants by default)")
+    contest.add_argument("--advance", type=int, nargs="*", default=[3], help="players going through after each round before the last")
+    contest.add_argument("--tie-break", choices=["shoot_off", "previous_round"], default="shoot_off")
+
+    player = commands.add_parser("player", help="score distribution of one player's round")
+    player.add_argument("playerid")
+    player.add_argument("--model", choices=["bayesian", "log_reg"], default="bayesian")
+    player.add_argument("--n", type=int, default=100000, help="number of rounds")
+    player.add_argument("--exact", action="store_true", help="calculate the distribution exactly instead of simulating")
+
+    serve = commands.add_parser("serve", help="run the local pricing service")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8000)
+    serve.add_argument("--workers", type=int, default=2, help="worker processes running simulations")
+    serve.add_argument("--cache-size", type=int, default=256, help="number of recent queries to keep")
+    serve.add_argument("--max-pending", type=int, help="queries queued or running before new ones are turned away (default 4 per worker)")
+
+    fit = commands.add_parser("fit-priors", help="fit the bayesian prior to the contest history and store every player's posterior")
+    fit.add_argument("--season", default="2024-25", help="season of the shooting by distance table")
+
+    commands.add_parser("fit-sequence", help="fit the sequential shot model to the ordered shots in the contest history")
+
+    backtest = commands.add_parser("backtest", help="score the models' forecasts of past contests")
+    backtest.add_argument("--model", nargs="+", choices=["bayesian", "log_reg"], default=["bayesian", "log_reg"])
+    backtest.add_argument("--k", type=float, nargs="+", help="prior weights (bayesian) or contest uplifts (log_reg) to try, each model's default if not given")
+    backtest.add_argument("--workers", type=int, help="worker processes building the models (one per CPU by default)")
+    backtest.add_argument("--refresh", action="store_true", help="rebuild every forecast instead of using the cached ones")
+    backtest.add_argument("--bins", type=int, default=10, help="number of bins in the calibration curves")
+    backtest.add_argument("--format", choices=["text", "json"], default="text")
+
+    for command in (contest, player):
+        command.add_argument("--seed", type=int)
+        command.add_argument("--workers", type=int, default=1)
+        command.add_argument("--sampling", choices=["iid", "crn", "antithetic", "sobol"], default="iid")
+        command.add_argument("--format", choices=["text", "json"], default="text")
+        command.add_argument("--sequential", action="store_true", help="let make probabilities depend on the shots before (see shot_sequence)")
+    return parser
+
+def run_contest(args):
+    from simulate import simulate_contest
+
+    contest_format = {"advance": args.advance, "tie_break": args.tie_break}
+    results = simulate_contest(args.model, args.n, exact=args.exact, seed=args.seed, workers=args.workers, sampling=args.sampling,
+                               tolerance=args.tolerance, target=args.target, print_odds=False, playerids=args.players, contest_format=contest_format,
+                               sequential=args.sequential)
+    players = []
+    for i, playerid in enumerate(results["playerids"]):
+        prob = float(results["probs"][i])
+        players.append({"playerid": playerid, "name": results["names"][i], "prob": prob,
+                        "se": float(results["se"][i]), "odds": round(1 / prob, 2) if prob > 0 else None})
+    return {"model": args.model, "n": results["n"], "seed": args.seed, "exact": args.exact, "format": contest_format, "players": players}
+
+def run_player(args):
+    import numpy as np
+    from simulate import simulate, estimate_mean
+    from data_collection import get_name_by_id
+
+    if args.exact:
+        pmf = simulate(args.playerid, args.model, exact=True)
+        mean, se = float(np.arange(len(pmf)) @ pmf), 0.0
+    else:
+        scores = simulate(args.playerid, args.model, args.n, seed=args.seed, workers=args.workers, sampling=args.sampling, sequential=args.sequential)
+        pmf = np.bincount(scores, minlength=41) / len(scores)
+        mean, se = estimate_mean(scores, args.sampling)
+    return {"playerid": args.playerid, "name": get_name_by_id(args.playerid), "model": args.model, "n": args.n,
+            "seed": args.seed, "exact": args.exact, "mean": float(mean), "se": float(se), "pmf": [float(p) for p in pmf]}
+
+def run_backtest(args):
+    from backtest import backtest
+    configs = [{"model": model, "k": k} for model in args.model for k in (args.k or [None])]
+    return backtest(configs, workers=args.workers, refresh=args.refresh, bins=args.bins)
+
+def print_text(command, output):
+    if command == "backtest":
+        names = [" ".join(f"{key}={value:g}" if key != "model" else value for key, value in report["config"].items()) for report in output]
+        rows = [(name, report) for name, report in zip(names, output)]
+        # Contests from before the shot charts, where every forecast is built from the fallback prior, on rows of their own
+        rows += [(f"{name} (before charts)", report["before_shot_charts"]) for name, report in zip(names, output)
+                 if report["before_shot_charts"]["round"]["count"] or report["before_shot_charts"]["win"]["count"]]
+        width = max(28, max(len(name) for name, _ in rows) + 2)
+        print(f"{'model':<{width}}{'rounds':>8}{'brier':>8}{'log loss':>10}{'mean':>8}{'actual':>8}{'contests':>10}{'brier':>8}{'log loss':>10}")
+        for name, report in rows:
+            row = f"{name:<{width}}{report['round']['count']:>8}"
+            if report["round"]["count"]:
+                row += f"{report['round']['brier']:>8.4f}{report['round']['log_loss']:>10.4f}{report['round']['mean_predicted']:>8.2f}{report['round']['mean_actual']:>8.2f}"
+            else:
+                row += f"{'-':>8}{'-':>10}{'-':>8}{'-':>8}"
+            row += f"{report['win']['count']:>10}"
+            if report["win"]["count"]:
+                row += f"{report['win']['brier']:>8.4f}{report['win']['log_loss']:>10.4f}"
+            print(row)
+        for name, report in zip(names, output):
+            for target in ["round", "win"]:
+                if report[target]["count"]:
+                    print(f"\n{name}: {target} calibration")
+                    print(f"{'bin':<11}{'predicted':>11}{'observed':>10}{'count':>8}")
+                    for point in report[target]["calibration"]:
+                        print(f"{point['low']:.2f}-{point['high']:.2f}{point['predicted']:>13.3f}{point['observed']:>10.3f}{point['count']:>8}")
+        return
+    if command == "simulate":
+        print(f"{'player':<24}{'win %':>8}{'± se':>8}{'odds':>8}")
+        for player in sorted(output["players"], key=lambda player: -player["prob"]):
+            odds = f"{player['odds']:.2f}" if player["odds"] else "-"
+            print(f"{player['name']:<24}{100 * player['prob']:>8.2f}{100 * player['se']:>8.2f}{odds:>8}")
+    else:
+        print(f"{output['name']}: mean score {output['mean']:.2f} (± {output['se']:.2f})")
+        for score, p in enumerate(output["pmf"]):
+            if p > 0:
+                print(f"{score:>3} {100 * p:6.2f}%")
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    from data_collection import MissingDataError
+
+    # Data files that have to be supplied or built by another command first, rather than a bug, so no traceback
+    try:
+        run_command(args)
+    except MissingDataError as e:
+        sys.exit(f"contest: error: {e}")
+
+def run_command(args):
+    if args.command == "serve":
+        from service import serve
+        serve(args.host, args.port, args.workers, args.cache_size, args.max_pending)
+        return
+    if args.command == "fit-priors":
+        from bayesian import fit_priors
+        settings = fit_priors(args.season)
+        print(f"Fitted to {settings['num_fitted']} contest shooters, posteriors stored for {settings['num_players']} players")
+        print(f"k = {settings['k']:.3f}, uplift = {settings['uplift']:.3f}, fallback prior = ({', '.join(f'{x:.2f}' for x in settings['fallback'])})")
+        return
+    if args.command == "fit-sequence":
+        from shot_sequence import fit_sequence_model
+        try:
+            sequence = fit_sequence_model()
+        except ValueError as e:
+            sys.exit(f"contest: error: {e}")
+        print(f"Fitted to {sequence['num_rounds']} rounds: hot = {sequence['hot']:.3f}, fatigue = {sequence['fatigue']:.3f}, pressure = {sequence['pressure']:.3f}")
+        return
+
+    if args.command == "simulate":
+        output = run_contest(args)
+    elif args.command == "backtest":
+        output = run_backtest(args)
+    else:
+        output = run_player(args)
+
+    if args.format == "json":
+        json.dump(output, sys.stdout, indent=2)
+        print()
+    else:
+        print_text(args.command, output)
+
+if __name__ == "__main__":
+    main()
@@ -1,67 +1,28 @@
 import os
-import time
-import requests
-import urllib.parse
 import json
-import pandas as pd
-from nba_api.stats.endpoints import shotchartdetail, playerindex
+import numpy as np
+from boxscore_store import get_store as get_boxscore_store
+from instrumentation import instrumented, count
 
 base_url = "https://d2c6afifpk.execute-api.eu-west-2.amazonaws.com/dev"
 
+# An input file that has to be supplied by hand or built by another command first, rather than downloaded
+class MissingDataError(FileNotFoundError):
+    pass
+
 # Queries API endpoint for information on all players and stores it in ./data/players.json
 def load_players():
-    first_page = requests.get(base_url+"/players").json()
-    players = first_page["results"]
-    queryExecutionId = first_page["queryExecutionId"]
-    if first_page["nextToken"]:
-        nextToken = urllib.parse.quote(first_page["nextToken"])
-    columns = urllib.parse.quote(json.dumps(first_page["columns"]).replace(" ", ""))
-
-    while True:
-        url = f"{base_url}/players?queryExecutionId={queryExecutionId}&nextToken={nextToken}&columns={columns}"
-        next_page = requests.get(url).json()
-        players.extend(next_page["results"])
-        if next_page["nextToken"]:
-            nextToken = urllib.parse.quote_plus(next_page["nextToken"])
-        else:
-            break
-
-    with open("data/players.json", "w") as f:
-        json.dump(players, f)
+    from api_client import PaginatedClient
+    PaginatedClient(base_url).fetch("/players", "data/players.json")
 
 # Queries API endpoint for player performance statistics and stores them in ./data/boxscores.json
 def load_boxscores():
-    first_page = requests.get(base_url+"/boxscores").json()
-    boxscores = first_page["results"]
-    queryExecutionId = first_page["queryExecutionId"]
-    if first_page["nextToken"]:
-        nextToken = urllib.parse.quote(first_page["nextToken"])
-    columns = urllib.parse.quote(json.dumps(first_page["columns"]).replace(" ", ""))
-
-    while True:
-        url = f"{base_url}/boxscores?queryExecutionId={queryExecutionId}&nextToken={nextToken}&columns={columns}"
-        next_page = requests.get(url).json()
-        boxscores.extend(next_page["results"])
-        if next_page["nextToken"]:
-            nextToken = urllib.parse.quote_plus(next_page["nextToken"])
-        else:
-            break
-
-    with open("data/boxscores.json", "w") as f:
-        json.dump(boxscores, f)
+    from api_client import PaginatedClient
+    PaginatedClient(base_url).fetch("/boxscores", "data/boxscores.json")
 
 # Searches the data for the required participants, given by their first and last names.
 # As of the current state of the data, this is enough to uniquely identify each participant.
 def load_participant_info():
-    try:
-        f = open("data/players.json")
-    except FileNotFoundError:
-        load_players()
-        f = open("data/players.json")
-
-    players = json.load(f)
-    f.close()
-
     participants = [{"firstname": "Jalen", "surname": "Brunson"}, 
                     {"firstname": "Cade", "surname": "Cunningham"},
                     {"firstname": "Darius", "surname": "Garland"},
@@ -71,63 +32,137 @@ def load_participant_info():
                     {"firstname": "Damian", "surname": "Lillard"},
                     {"firstname": "Norman", "surname": "Powell"}]
 
+    registry = get_registry()
     participant_info = []
-    for player in players:
-        for participant in participants:
-            if player["firstname"] == participant["firstname"] and player["surname"] == participant["surname"]:
-                participant_info.append(player)
+    for participant in participants:
+        participant_info.extend(registry.find_by_name(participant["firstname"], participant["surname"]))
+
+    # Keep the order of players.json
+    participant_info.sort(key=lambda player: int(player["row"]))
 
     with open("data/participants.json", "w") as f:
         json.dump(participant_info, f)
 
-load_participant_info()
+class PlayerRegistry:
+    '''
+    Index of every player in players.json, with O(1) lookups by playerid, by name and by nba_api PERSON_ID.
+    It is stored in data/player_registry.json as a list of rows, rather than one dict per player,
+    and is rebuilt whenever players.json changes.
+    '''
+    path = "data/player_registry.json"
+    source_path = "data/players.json"
+
+    def __init__(self):
+        if not os.path.exists(self.source_path):
+            load_players()
+
+        source = self.get_source_fingerprint()
+        data = None
+        nba_ids = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            if data["source"] != source:
+                nba_ids = data["nba_ids"]
+                data = None
+
+        if data is None:
+            with open(self.source_path, "r") as f:
+                players = json.load(f)
+            columns = list(players[0].keys()) if players else []
+            self.data = {"source": source,
+                         "columns": columns,
+                         "rows": [[player[column] for column in columns] for player in players],
+                         "nba_ids": nba_ids}
+            self.save()
+        else:
+            self.data = data
+
+        self.by_id = dict()
+        self.by_name = dict()
+        for row in self.data["rows"]:
+            player = dict(zip(self.data["columns"], row))
+            # Some players appear more than once. As before, the first entry wins when looking up by id.
+            self.by_id.setdefault(player["playerid"], player)
+            self.by_name.setdefault((player["firstname"], player["surname"]), []).append(player)
+        self.by_nba_id = {nba_id: self.by_id[playerid] for playerid, nba_id in self.data["nba_ids"].items() if playerid in self.by_id}
+
+    def get_source_fingerprint(self):
+        stat = os.stat(self.source_path)
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def save(self):
+        with open(self.path, "w") as f:
+            json.dump(self.data, f, separators=(",", ":"))
+
+    def get(self, playerid):
+        return self.by_id.get(str(playerid))
+
+    def get_name(self, playerid):
+        player = self.get(playerid)
+        if player is None:
+            return None
+        return f"{player["firstname"]} {player["surname"]}"
+
+    def find_by_name(self, firstname, surname):
+        return self.by_name.get((firstname, surname), [])
+
+    def get_nba_id(self, playerid):
+        return self.data["nba_ids"].get(str(playerid))
+
+    def get_by_nba_id(self, nba_id):
+        return self.by_nba_id.get(int(nba_id))
+
+    # Store nba_api PERSON_IDs, given as a dict of playerid -> PERSON_ID
+    def add_nba_ids(self, nba_ids):
+        for playerid, nba_id in nba_ids.items():
+            self.data["nba_ids"][str(playerid)] = int(nba_id)
+            if str(playerid) in self.by_id:
+                self.by_nba_id[int(nba_id)] = self.by_id[str(playerid)]
+        self.save()
+
+registry = None
+
+# The registry is loaded on first use, once per process
+@instrumented("data_collection.get_registry")
+def get_registry():
+    global registry
+    if registry is None:
+        registry = PlayerRegistry()
+    return registry
 
 def load_results():
-    first_page = requests.get(base_url+"/three_pt_contest_historical_results").json()
-    results = first_page["results"]
-    queryExecutionId = first_page["queryExecutionId"]
-    columns = urllib.parse.quote(json.dumps(first_page["columns"]).replace(" ", ""))
-
-    if first_page["nextToken"]:
-        nextToken = urllib.parse.quote(first_page["nextToken"])
-
-        while True:
-            url = f"{base_url}/three_pt_contest_historical_results?queryExecutionId={queryExecutionId}&nextToken={nextToken}&columns={columns}"
-            next_page = requests.get(url).json()
-            results.extend(next_page["results"])
-            if next_page["nextToken"]:
-                nextToken = urllib.parse.quote_plus(next_page["nextToken"])
-            else:
-                break
-
-    with open("data/results.json", "w") as f:
-        json.dump(results, f)
+    from api_client import PaginatedClient
+    PaginatedClient(base_url).fetch("/three_pt_contest_historical_results", "data/results.json")
 
 def load_3ptfg_last_100(playerid):
-    try:
-        boxscores = pd.read_json("data/boxscores.json")
-    except FileNotFoundError:
-        load_boxscores()
-        boxscores = pd.read_json("data/boxscores.json")
-
-    if not os.path.exists("data/3ptfg_last_100.json"):
-        with open("data/3ptfg_last_100.json", "w") as f:
-            json.dump({}, f)
-
-    player_boxscores = boxscores[boxscores['player'] == playerid].tail(100)
-    player_boxscores["threepointers"] = pd.to_numeric(player_boxscores["threepointers"])
-    player_boxscores["threepointersattempted"] = pd.to_numeric(player_boxscores["threepointersattempted"])
-    made = player_boxscores["threepointers"].sum()
-    att = player_boxscores["threepointersattempted"].sum()
-    try:    
-        pc = round(100 * float(made) / float(att), 1)
-    except ZeroDivisionError:
-        pc = 0
-    
-    new_data = {"made": int(made), "att": int(att), "3pt%": pc}
-    with open("data/3ptfg_last_100.json", "r") as f:
-        data = json.load(f)
-        data[str(playerid)] = new_data
+    return load_3ptfg_last_100_many([playerid])[str(playerid)]
+
+# Same as load_3ptfg_last_100 for a list of players, reading and writing 3ptfg_last_100.json only once.
+# Players with no games in the boxscores get zeros, but aren't written to the file, so they are looked up again
+# once the boxscores are downloaded again.
+@instrumented("data_collection.load_3ptfg_last_100")
+def load_3ptfg_last_100_many(playerids):
+    store = get_boxscore_store()
+
+    new_data = dict()
+    for playerid in playerids:
+        made = int(store.get_last_n(playerid, "threepointers", 100).sum())
+        att = int(store.get_last_n(playerid, "threepointersattempted", 100).sum())
+        try:    
+            pc = round(100 * float(made) / float(att), 1)
+        except ZeroDivisionError:
+            pc = 0
+        new_data[str(playerid)] = {"made": made, "att": att, "3pt%": pc}
+
+    found = {playerid: last_100 for playerid, last_100 in new_data.items() if store.has_player(playerid)}
+    if not found:
+        return new_data
+    data = dict()
+    if os.path.exists("data/3ptfg_last_100.json"):
+        with open("data/3ptfg_last_100.json", "r") as f:
+            data = json.load(f)
+    data.update(found)
 
     with open("data/3ptfg_last_100.json", "w") as f:
         json.dump(data, f)
@@ -135,35 +170,13 @@ def load_3ptfg_last_100(playerid):
     return new_data
 
 def get_name_by_id(playerid):
-    # Search participants.json first (kind of like a cache)
-    try:
-        f = open("data/participants.json")
-    except FileNotFoundError:
-        load_participant_info()
-        f = open("data/participants.json")
-    
-    players = json.load(f)
-    f.close()
-
-    for player in players:
-        if player["playerid"] == str(playerid):
-            return f"{player["firstname"]} {player["surname"]}"
-        
-    # If not found then search players.json
-    try:
-        f = open("data/players.json")
-    except FileNotFoundError:
-        load_participant_info()
-        f = open("data/players.json")
-    
-    players = json.load(f)
-    f.close()
+    return get_registry().get_name(playerid)
 
-    for player in players:
-        if player["playerid"] == str(playerid):
-            return f"{player["firstname"]} {player["surname"]}"
-
-def load_shot_distance_data(playerid):
+# Downloads the league-wide shooting by distance table for a season and stores the columns we use,
+# indexed by nba_api PLAYER_ID, in ./data/shot_locations/{season}.npz
+def load_shot_location_table(season="2024-25"):
+    import requests
+    import pandas as pd
 
     # Scrape data from https://www.nba.com/stats/players/shooting by accessing the underlying API
     # Replicate the network request:
@@ -203,7 +216,7 @@ def load_shot_distance_data(playerid):
         "PlayerPosition": "",
         "PlusMinus": "N",
         "Rank": "N",
-        "Season": "2024-25",
+        "Season": season,
         "SeasonSegment": "",
         "SeasonType": "Regular Season",
         "ShotClockRange": "",
@@ -226,63 +239,59 @@ def load_shot_distance_data(playerid):
 
     df = pd.DataFrame(rows, columns=all_columns)
 
-    if not os.path.exists("data/shot_pc_by_dist.json"):
-        with open("data/shot_pc_by_dist.json", "w") as f:
-            json.dump({}, f)
-
-    df = df[df['PLAYER_NAME'] == get_name_by_id(playerid)]
-    new_data = {"fgm_20-24": df.at[df.index[0], 'FGM_20-24ft'],
-                "fga_20-24": df.at[df.index[0], 'FGA_20-24ft'],
-                "fg_pc_20-24": df.at[df.index[0], 'FG_PCT_20-24ft'],
-                "fgm_25-29": df.at[df.index[0], 'FGM_25-29ft'],
-                "fga_25-29": df.at[df.index[0], 'FGA_25-29ft'],
-                "fg_pc_25-29": df.at[df.index[0], 'FG_PCT_25-29ft'],
-                }
-    with open("data/shot_pc_by_dist.json", "r") as f:
-        data = json.load(f)
-        data[str(playerid)] = new_data
+    os.makedirs("data/shot_locations", exist_ok=True)
+    table = {"PLAYER_ID": df['PLAYER_ID'].to_numpy(dtype=np.int64),
+             "PLAYER_NAME": df['PLAYER_NAME'].to_numpy(dtype=str)}
+    for key, column in shot_location_columns.items():
+        table[key] = np.nan_to_num(pd.to_numeric(df[column]).to_numpy(dtype=np.float64))
+    np.savez(f"data/shot_locations/{season}.npz", **table)
+
+# Keys in shot_pc_by_dist.json and the table columns they come from
+shot_location_columns = {"fgm_20-24": 'FGM_20-24ft',
+                         "fga_20-24": 'FGA_20-24ft',
+                         "fg_pc_20-24": 'FG_PCT_20-24ft',
+                         "fgm_25-29": 'FGM_25-29ft',
+                         "fga_25-29": 'FGA_25-29ft',
+                         "fg_pc_25-29": 'FG_PCT_25-29ft'}
+
+# season -> {"by_id": {PLAYER_ID: row}, "by_name": {PLAYER_NAME: row}}, loaded once per process
+shot_location_tables = dict()
+
+def get_shot_location_table(season="2024-25"):
+    count("data_collection.get_shot_location_table", cache_hit=int(season in shot_location_tables), cache_miss=int(season not in shot_location_tables))
+    if season not in shot_location_tables:
+        path = f"data/shot_locations/{season}.npz"
+        if not os.path.exists(path):
+            load_shot_location_table(season)
+        table = np.load(path)
+
+        by_id = dict()
+        by_name = dict()
+        for i, (nba_id, name) in enumerate(zip(table['PLAYER_ID'], table['PLAYER_NAME'])):
+            row = {key: float(table[key][i]) for key in shot_location_columns}
+            by_id[int(nba_id)] = row
+            by_name.setdefault(str(name), row)
+        shot_location_tables[season] = {"by_id": by_id, "by_name": by_name}
+    return shot_location_tables[season]
+
+# Looks up a player's 20-24ft and 25-29ft shooting in the league table, and caches it in ./data/shot_pc_by_dist.json
+def load_shot_distance_data(playerid, season="2024-25"):
+    table = get_shot_location_table(season)
+
+    # Match on PLAYER_ID if we know the player's nba_api id, otherwise on their name as before
+    nba_id = get_registry().get_nba_id(playerid)
+    if nba_id is not None and nba_id in table["by_id"]:
+        new_data = dict(table["by_id"][nba_id])
+    else:
+        new_data = dict(table["by_name"][get_name_by_id(playerid)])
+
+    data = dict()
+    if os.path.exists("data/shot_pc_by_dist.json"):
+        with open("data/shot_pc_by_dist.json", "r") as f:
+            data = json.load(f)
+    data[str(playerid)] = new_data
 
     with open("data/shot_pc_by_dist.json", "w") as f:
         json.dump(data, f)
     
     return new_data
-
-# Data collection from nba_api
-def load_shot_chart(playerid):
-    output_path = f"data/shot_charts/{playerid}.json"
-
-    player_name = get_name_by_id(playerid).split(" ")
-    data = playerindex.PlayerIndex().get_data_frames()[0]
-    data = data[data['PLAYER_FIRST_NAME']==player_name[0]]
-    data = data[data['PLAYER_LAST_NAME']==player_name[1]]
-    nba_api_id = data.at[data.index[0], 'PERSON_ID']
-
-    shots = []
-    
-    start_year = 2021
-    end_year = 2024
-    for year in range(start_year, end_year+1):
-        season = f"{year}-{str(year + 1)[-2:]}"
-        shotchart = shotchartdetail.ShotChartDetail(
-            team_id=0,
-            player_id=nba_api_id,
-            season_type_all_star='Regular Season',
-            season_nullable=season,
-            context_measure_simple='FG3A'
-        )
-        time.sleep(1)
-        
-        shots.append(shotchart.get_data_frames()[0])
-
-    shot_data = pd.concat(shots)
-
-    shot_data = shot_data[shot_data['ACTION_TYPE'] == 'Jump Shot']
-    # shot_data = shot_data[['LOC_X', 'LOC_Y', 'SHOT_ZONE_AREA', 'SHOT_MADE_FLAG']]
-
-    new_shots = shot_data.to_dict(orient='records')
-
-    with open(output_path, "w") as f:
-        json.dump(new_shots, f, indent=2)
-
-    return new_shots
-
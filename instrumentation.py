@@ -0,0 +1,179 @@
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+'''
+Lightweight instrumentation for finding where a pricing run spends its time.
+Stages are timed with nested spans, and can also count bytes read/downloaded and cache hits/misses.
+It is off by default, in which case span() returns a shared do-nothing object and instrumented functions
+are called directly, so leaving the hooks in the code costs almost nothing.
+
+    import instrumentation
+    instrumentation.enable()
+    simulate_contest("bayesian", n=100000)
+    instrumentation.write_json("stages.json")
+    instrumentation.write_chrome_trace("trace.json")   # open in chrome://tracing or Perfetto
+
+Only the calling process is recorded, so run with workers=1 to see inside the simulation chunks.
+'''
+
+enabled = False
+
+# name -> {"calls", "wall_time", and any counters}
+stages = dict()
+# Finished spans, as Chrome trace events
+events = []
+
+lock = threading.Lock()
+local = threading.local()
+start_time = time.perf_counter()
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    global start_time
+    with lock:
+        stages.clear()
+        events.clear()
+    start_time = time.perf_counter()
+
+class Span:
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.counters = Counter()
+        # Counters recorded by count() for other stages while this span was open, shown in its trace event
+        self.inner_counters = Counter()
+
+    def __enter__(self):
+        stack = getattr(local, "stack", None)
+        if stack is None:
+            stack = local.stack = []
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        local.stack.pop()
+        with lock:
+            stage = stages.setdefault(self.name, {"calls": 0, "wall_time": 0.0})
+            stage["calls"] += 1
+            stage["wall_time"] += end - self.start
+            for key, value in self.counters.items():
+                stage[key] = stage.get(key, 0) + value
+            events.append({"name": self.name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                           "ts": 1e6 * (self.start - start_time), "dur": 1e6 * (end - self.start),
+                           "args": {**self.args, **self.counters, **self.inner_counters, "parent": self.parent}})
+        return False
+
+    # Add to this span's counters, e.g. add(bytes_read=1024) or add(cache_hit=1)
+    def add(self, **counters):
+        self.counters.update(counters)
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, **counters):
+        pass
+
+null_span = NullSpan()
+
+def span(name, **args):
+    if not enabled:
+        return null_span
+    return Span(name, args)
+
+# Add counters to the named stage. The innermost open span also shows them in its trace event, as "{name}:{counter}".
+def count(name, **counters):
+    if not enabled:
+        return
+    stack = getattr(local, "stack", None)
+    if stack:
+        stack[-1].inner_counters.update({f"{name}:{key}": value for key, value in counters.items()})
+    with lock:
+        stage = stages.setdefault(name, {"calls": 0, "wall_time": 0.0})
+        for key, value in counters.items():
+            stage[key] = stage.get(key, 0) + value
+
+# Decorator recording every call of a function as a span
+def instrumented(name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            with Span(name, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Size of a file, to count as bytes read
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def get_stages():
+    with lock:
+        return {name: dict(stage) for name, stage in stages.items()}
+
+def write_json(path):
+    with open(path, "w") as f:
+        json.dump({"stages": get_stages(), "spans": list(events)}, f, indent=2)
+
+def write_chrome_trace(path):
+    with open(path, "w") as f:
+        json.dump({"traceEvents": list(events), "displayTimeUnit": "ms"}, f)
+
+def sample_profile(fn, *args, interval=0.001, **kwargs):
+    '''
+    Sampling profiler for a single call, e.g. sample_profile(simulate_contest, "bayesian", n=100000).
+    A background thread records the calling thread's stack every interval seconds.
+    Returns fn's result and a Counter of how many samples each stack ("outer;...;inner") got.
+    '''
+    thread_id = threading.get_ident()
+    samples = Counter()
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                # Leave out the instrumented() wrappers
+                if frame.f_code.co_filename != __file__:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})")
+                frame = frame.f_back
+            samples[";".join(reversed(stack))] += 1
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        result = fn(*args, **kwargs)
+    finally:
+        done.set()
+        sampler.join()
+    return result, samples
+
+# Write sampled stacks in the collapsed format read by flamegraph.pl and speedscope
+def write_collapsed_stacks(samples, path):
+    with open(path, "w") as f:
+        for stack, n in samples.most_common():
+            f.write(f"{stack} {n}\n")
@@ -1,45 +1,137 @@
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
 import os
 import json
-import pandas as pd
-import joblib
-from sklearn.metrics import classification_report, confusion_matrix
-from sklearn.preprocessing import OneHotEncoder
-from sklearn.compose import ColumnTransformer
-from sklearn.pipeline import Pipeline
-from sklearn.linear_model import LogisticRegression
-from sklearn.model_selection import train_test_split
-from data_collection import load_shot_chart
+import numpy as np
+from instrumentation import instrumented, span, count, file_size
+from shot_charts import load_shot_chart, ingest_shot_charts, has_shot_chart, get_season_path, convert_json_shot_charts, seasons
 
+# Only the columns used for training are read from the stored shot charts
 def get_shot_chart(playerid):
-    path = f"data/shot_charts/{playerid}.json"
-    if not os.path.exists(path):
-        return pd.DataFrame(load_shot_chart(playerid))
-    
-    with open(path, "r") as f:
-        data = json.load(f)
+    return load_shot_chart(playerid, pipeline_config["features"] + ['SHOT_MADE_FLAG'])
+
+# Everything about the pipeline that affects the fitted model. Changing any of these retrains the stored models.
+pipeline_config = {
+    "features": ['LOC_X', 'LOC_Y', 'SHOT_ZONE_AREA', 'SHOT_DISTANCE', 'SHOT_TYPE'],
+    "categorical": ['SHOT_ZONE_AREA', 'SHOT_TYPE'],
+    "max_iter": 5000,
+    "test_size": 0.1,
+    "random_state": 42,
+}
 
-    return pd.DataFrame(data)
+# The untrained pipeline: one-hot encoding for the categorical columns, then the classifier
+def make_pipeline(clf=None):
+    from sklearn.preprocessing import OneHotEncoder
+    from sklearn.compose import ColumnTransformer
+    from sklearn.pipeline import Pipeline
+    from sklearn.linear_model import LogisticRegression
 
+    if clf is None:
+        clf = LogisticRegression(max_iter=pipeline_config["max_iter"])
+    transformer = ColumnTransformer(transformers=[('cat', OneHotEncoder(handle_unknown='ignore'), pipeline_config["categorical"])], remainder='passthrough')
+    return Pipeline([('preprocess', transformer), ('clf', clf)])
+
+@instrumented("logistic_regression.train")
 def train(playerid, print_eval=False):
+    # sklearn is only needed for training, so simulations that just read the probability grids never import it
+    import joblib
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.model_selection import train_test_split
+
     df = get_shot_chart(playerid)
-    x = df[['LOC_X', 'LOC_Y', 'SHOT_ZONE_AREA', 'SHOT_DISTANCE', 'SHOT_TYPE']]
+    x = df[pipeline_config["features"]]
     y = df['SHOT_MADE_FLAG']
 
-    # One-Hot encoding for categorical columns
-    transformer = ColumnTransformer(transformers=[('cat', OneHotEncoder(handle_unknown='ignore'), ['SHOT_ZONE_AREA', 'SHOT_TYPE'])], remainder='passthrough')
+    # Start from the previous model's coefficients if there is one, which usually converges in far fewer iterations
+    clf = LogisticRegression(max_iter=pipeline_config["max_iter"], warm_start=True)
+    previous = load_previous_model(playerid)
+    if previous is not None:
+        clf.coef_ = previous.named_steps['clf'].coef_.copy()
+        clf.intercept_ = previous.named_steps['clf'].intercept_.copy()
 
-    pipeline = Pipeline([('preprocess', transformer), ('clf', LogisticRegression(max_iter=5000))])
+    pipeline = make_pipeline(clf)
 
-    x_train, x_test, y_train, y_test = train_test_split(x, y, test_size=0.1, random_state=42)
-    pipeline.fit(x_train, y_train)
+    x_train, x_test, y_train, y_test = train_test_split(x, y, test_size=pipeline_config["test_size"], random_state=pipeline_config["random_state"])
+    try:
+        pipeline.fit(x_train, y_train)
+    except ValueError:
+        # The previous coefficients don't fit the new features (e.g. a new shot zone appeared), so start from scratch
+        pipeline.set_params(clf=LogisticRegression(max_iter=pipeline_config["max_iter"]))
+        pipeline.fit(x_train, y_train)
     # print(pipeline.predict_proba(x)[:, 1])
     if print_eval:
         evaluate(pipeline, x_test, y_test)
 
     joblib.dump(pipeline, f"data/models/{playerid}.joblib")
+    build_grid(playerid, pipeline)
+    with open(f"data/models/{playerid}.json", "w") as f:
+        json.dump({"fingerprint": get_training_fingerprint(playerid)}, f)
     return pipeline
 
+def load_previous_model(playerid):
+    import joblib
+    path = f"data/models/{playerid}.joblib"
+    if not os.path.exists(path):
+        return None
+    try:
+        with span("joblib.load") as s:
+            s.add(bytes_read=file_size(path))
+            return joblib.load(path)
+    except Exception:
+        return None
+
+# Hash of the training data and pipeline config. A stored model is only reused if this hasn't changed.
+def get_training_fingerprint(playerid):
+    h = hashlib.sha256(json.dumps(pipeline_config, sort_keys=True).encode())
+    # Hash the stored arrays rather than the files, so re-downloading an unchanged season doesn't retrain the model
+    for season in seasons:
+        with np.load(get_season_path(playerid, season)) as data:
+            for column in sorted(data.files):
+                h.update(column.encode())
+                h.update(data[column].tobytes())
+    return h.hexdigest()
+
+@instrumented("logistic_regression.is_model_current")
+def is_model_current(playerid):
+    current = False
+    if os.path.exists(f"data/models/{playerid}.joblib") and has_shot_chart(playerid):
+        try:
+            with open(f"data/models/{playerid}.json", "r") as f:
+                current = json.load(f)["fingerprint"] == get_training_fingerprint(playerid)
+        except FileNotFoundError:
+            pass
+    count("logistic_regression.is_model_current", cache_hit=int(current), cache_miss=int(not current))
+    return current
+
+def get_model(playerid):
+    import joblib
+    if is_model_current(playerid):
+        with span("joblib.load") as s:
+            s.add(bytes_read=file_size(f"data/models/{playerid}.joblib"))
+            return joblib.load(f"data/models/{playerid}.joblib")
+    return train(playerid)
+
+# Retrain the models of any players whose training data or pipeline config has changed, in parallel
+def train_models(playerids, workers=None):
+    stale = [playerid for playerid in playerids if not is_model_current(playerid)]
+    if not stale:
+        return
+    # Make sure shot charts are downloaded before starting the pool, so the downloads share one rate limiter
+    convert_json_shot_charts(stale)
+    missing = [playerid for playerid in stale if not has_shot_chart(playerid)]
+    if missing:
+        ingest_shot_charts(missing)
+
+    if workers == 1 or len(stale) == 1:
+        for playerid in stale:
+            train(playerid)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(train, stale))
+
 def evaluate(pipeline, x_test, y_test):
+    from sklearn.metrics import classification_report, confusion_matrix
     y_pred = pipeline.predict(x_test)
     print(classification_report(y_test, y_pred))
     print(confusion_matrix(y_test, y_pred))
@@ -54,29 +146,89 @@ However, we are going to use this model not for classification, but for a Monte-
 so this is fine, as we are using the probabilities directly rather than for classification under a threshold.
 '''
 
-def get_probabilities_by_location(playerid):
-    path = f"data/models/{playerid}.joblib"
-    if os.path.exists(path):
-        model = joblib.load(path)
-    else:
-        model = train(playerid)
-
-    # Get prediction of probability in each spot
-    three_point_locations = [
-        {"LOC_X": -220, "LOC_Y": 0,   "SHOT_ZONE_AREA": "Left Side(L)",          "SHOT_DISTANCE": 22, "SHOT_TYPE": "3PT Field Goal"},
-        {"LOC_X": -150, "LOC_Y": 220, "SHOT_ZONE_AREA": "Left Side Center(LC)",  "SHOT_DISTANCE": 24, "SHOT_TYPE": "3PT Field Goal"},
-        {"LOC_X": 0,    "LOC_Y": 260, "SHOT_ZONE_AREA": "Center(C)",             "SHOT_DISTANCE": 24, "SHOT_TYPE": "3PT Field Goal"},
-        {"LOC_X": 150,  "LOC_Y": 220, "SHOT_ZONE_AREA": "Right Side Center(RC)", "SHOT_DISTANCE": 24, "SHOT_TYPE": "3PT Field Goal"},
-        {"LOC_X": 220,  "LOC_Y": 0,   "SHOT_ZONE_AREA": "Right Side(R)",         "SHOT_DISTANCE": 22, "SHOT_TYPE": "3PT Field Goal"},
-        {"LOC_X": -92,  "LOC_Y": 290, "SHOT_ZONE_AREA": "Left Side Center(LC)",  "SHOT_DISTANCE": 30, "SHOT_TYPE": "3PT Field Goal"},
-        {"LOC_X": 92,   "LOC_Y": 290, "SHOT_ZONE_AREA": "Right Side Center(RC)", "SHOT_DISTANCE": 30, "SHOT_TYPE": "3PT Field Goal"}
-    ]
-
-    df = pd.DataFrame(three_point_locations)
-    thetas = model.predict_proba(df)[:, 1]
-    # Constant multiplicative scaling by the league average difference shooting percentage between in game and 3pt contest 3s.
-    # Can we now weight this based on the percentage of in-game 3s are wide open?
-    k = 5/4
-    return [theta * k for theta in thetas]
+# Constant multiplicative scaling by the league average difference shooting percentage between in game and 3pt contest 3s.
+# Can we now weight this based on the percentage of in-game 3s are wide open?
+CONTEST_UPLIFT = 5/4
+
+# Rack spots as (LOC_X, LOC_Y) in shot chart coordinates (tenths of a foot from the hoop, negative x on the left):
+# the five racks from left corner to right corner, then the two dew ball spots. The racks are 22 ft out in the
+# corners and 24 ft elsewhere, and the dew balls 30 ft out on the wings. All of them are on grid points.
+RACK_LOCATIONS = [(-220, 0), (-140, 200), (0, 240), (140, 200), (220, 0), (-110, 280), (110, 280)]
+
+# Court grid the models are baked into: 1 ft spacing over the half court, from the baseline to just short of halfcourt
+GRID_SPACING = 10
+GRID_X = np.arange(-250, 251, GRID_SPACING)
+GRID_Y = np.arange(-50, 421, GRID_SPACING)
+
+def get_grid_path(playerid):
+    return f"data/models/{playerid}_grid.npy"
+
+# SHOT_ZONE_AREA as the shot charts label it. Corner threes are below 8.75 ft from the hoop, and above that
+# the court is split into sectors at 72 and 108 degrees.
+def get_shot_zone_area(x, y):
+    x = np.asarray(x)
+    y = np.asarray(y)
+    angle = np.degrees(np.arctan2(y, x))
+    return np.select(
+        [y > 422.5, (y < 87.5) & (x >= 0), y < 87.5, angle < 72, angle > 108],
+        ["Back Court(BC)", "Right Side(R)", "Left Side(L)", "Right Side Center(RC)", "Left Side Center(LC)"],
+        "Center(C)")
+
+# Model features for shots from the given coordinates, with the zone and distance worked out as in the shot charts
+def get_location_features(x, y):
+    import pandas as pd
+    x = np.asarray(x)
+    y = np.asarray(y)
+    return pd.DataFrame({
+        "LOC_X": x,
+        "LOC_Y": y,
+        "SHOT_ZONE_AREA": get_shot_zone_area(x, y),
+        "SHOT_DISTANCE": np.floor(np.hypot(x, y) / 10).astype(int),
+        "SHOT_TYPE": "3PT Field Goal",
+    })
+
+def build_grid(playerid, pipeline):
+    '''
+    Evaluate a trained pipeline at every point of the court grid and save it as a (len(GRID_Y), len(GRID_X)) float32 array.
+    The grid holds the in-game make probability, before the contest uplift.
+    '''
+    x, y = np.meshgrid(GRID_X, GRID_Y)
+    grid = pipeline.predict_proba(get_location_features(x.ravel(), y.ravel()))[:, 1].reshape(x.shape).astype(np.float32)
+    np.save(get_grid_path(playerid), grid)
+    return grid
+
+@instrumented("logistic_regression.get_grid")
+def get_grid(playerid):
+    if not is_model_current(playerid):
+        train(playerid)
+    elif not os.path.exists(get_grid_path(playerid)):
+        build_grid(playerid, get_model(playerid))
+    count("logistic_regression.get_grid", bytes_read=file_size(get_grid_path(playerid)))
+    return np.load(get_grid_path(playerid))
+
+def get_probabilities_at(playerids, locations):
+    '''
+    Make probabilities for several players at several (LOC_X, LOC_Y) locations, by bilinear interpolation on their grids.
+    Returns a (len(playerids), len(locations)) array. Locations off the grid take the value at the nearest edge.
+    '''
+    grids = np.stack([get_grid(playerid) for playerid in playerids])
+    x, y = np.asarray(locations, dtype=np.float64).T
+
+    fx = (x - GRID_X[0]) / GRID_SPACING
+    fy = (y - GRID_Y[0]) / GRID_SPACING
+    i = np.clip(np.floor(fx).astype(int), 0, len(GRID_X) - 2)
+    j = np.clip(np.floor(fy).astype(int), 0, len(GRID_Y) - 2)
+    tx = np.clip(fx - i, 0, 1)
+    ty = np.clip(fy - j, 0, 1)
+
+    return ((1 - ty) * ((1 - tx) * grids[:, j, i] + tx * grids[:, j, i + 1])
+            + ty * ((1 - tx) * grids[:, j + 1, i] + tx * grids[:, j + 1, i + 1]))
+
+# Shooting percentage at each rack spot for several players at once, scaled up by k
+def get_probabilities_by_location_many(playerids, k=CONTEST_UPLIFT, locations=RACK_LOCATIONS):
+    return get_probabilities_at(playerids, locations) * k
+
+def get_probabilities_by_location(playerid, k=CONTEST_UPLIFT, locations=RACK_LOCATIONS):
+    return list(get_probabilities_by_location_many([playerid], k, locations)[0])
 
 # print(get_probabilities_by_location(1050))
\ No newline at end of file
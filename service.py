@@ -0,0 +1,249 @@
+import json
+import signal
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from simulate import (get_participants, get_field, get_params_many, get_money_balls, get_score_pmf, exact_contest_probs, run_chunks,
+                      sim_contests, sim_player_rounds, get_standard_error, estimate_mean, get_rounds, get_exact_format,
+                      SAMPLING_STRATEGIES, CONTEST_FORMAT)
+from logistic_regression import train_models
+from data_collection import get_name_by_id
+
+'''
+Local pricing service that keeps model parameters in memory between queries.
+
+    python contest.py serve --port 8000 --workers 4
+
+    curl -X POST localhost:8000/contest -d '{"model": "bayesian", "n": 100000, "seed": 1}'
+    curl -X POST localhost:8000/contest -d '{"playerids": ["1050", "1314", "1372"], "money_racks": [4, 2, 0], "advance": [2]}'
+    curl -X POST localhost:8000/contest -d '{"advance": [4, 2], "tie_break": "previous_round"}'
+    curl -X POST localhost:8000/player -d '{"playerid": "1050", "model": "log_reg", "exact": true}'
+
+Parameters are resolved once in the server process (and again only if their data files change), and the
+simulations run on a pool of worker processes that stay warm between queries. At most max_pending queries are
+queued or running at once, and any more are turned away with 503. Recent queries are cached by their arguments
+and the parameters they used, so repeating a query answers straight from memory.
+'''
+
+class ServiceBusy(Exception):
+    pass
+
+# Runs in a worker process: contests with a money rack layout per player
+def run_contest_job(n, seed, params, layouts, model, sampling, contest_format):
+    kwargs = {"params": params, "model": model, "contest_format": contest_format, "layouts": layouts, "sampling": sampling}
+    results = run_chunks(sim_contests, kwargs, n, seed)
+    wins = sum(result[0] for result in results)
+    return wins, get_standard_error([result[1] for result in results])
+
+# Runs in a worker process: n rounds for one player
+def run_player_job(n, seed, params, money_balls, model, sampling):
+    scores = np.concatenate(run_chunks(sim_player_rounds, {"params": params, "model": model, "money_balls": money_balls, "dew_balls": [10, 16], "sampling": sampling}, n, seed))
+    mean, se = estimate_mean(scores, sampling)
+    return np.bincount(scores, minlength=41) / n, mean, se
+
+class PricingService:
+    def __init__(self, workers=2, cache_size=256, max_pending=None):
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(max_pending or 4 * workers)
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        # Held while retraining log_reg models, so concurrent queries don't both retrain and write the same model files
+        self.train_lock = threading.Lock()
+
+    # Load the participants' parameters for each model, training any out of date log_reg models first
+    def warm(self, models=("bayesian", "log_reg")):
+        ids, _ = get_participants()
+        for model in models:
+            if model == "log_reg":
+                self.train(ids)
+            get_params_many(ids, model)
+        # Start the worker processes now rather than on the first query
+        list(self.executor.map(int, range(self.workers)))
+
+    # Retrain any out of date log_reg models, one query at a time
+    def train(self, playerids):
+        with self.train_lock:
+            train_models(playerids)
+
+    def run(self, key, fn, *args):
+        '''
+        Run fn(*args) on the worker pool, or return the cached result of an identical query.
+        Returns the result and whether it came from the cache.
+        '''
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key], True
+
+        if not self.slots.acquire(blocking=False):
+            raise ServiceBusy("Too many queries in progress")
+        try:
+            result = self.executor.submit(fn, *args).result()
+        finally:
+            self.slots.release()
+
+        with self.lock:
+            self.cache[key] = result
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return result, False
+
+    def price_contest(self, query):
+        '''
+        Win probabilities for a field. query can give model, n, seed, sampling, exact, k (the model's scale factor),
+        playerids (the participants by default), money_racks (one rack for everyone, or one per player),
+        and advance and tie_break for the format (see CONTEST_FORMAT).
+        '''
+        model = query.get("model", "bayesian")
+        n = get_n(query)
+        seed = query.get("seed")
+        sampling = query.get("sampling", "iid")
+        k = query.get("k")
+        if model not in ("bayesian", "log_reg"):
+            raise ValueError(f"Unknown model: {model}")
+        if sampling not in SAMPLING_STRATEGIES:
+            raise ValueError(f"Unknown sampling strategy: {sampling}")
+
+        ids, names = get_field(query.get("playerids") or None)
+        contest_format = {"advance": query.get("advance", CONTEST_FORMAT["advance"]), "tie_break": query.get("tie_break", CONTEST_FORMAT["tie_break"])}
+        get_rounds(contest_format, len(ids))
+
+        racks = query.get("money_racks", 4)
+        if isinstance(racks, int):
+            racks = [racks] * len(ids)
+        if len(racks) != len(ids):
+            raise ValueError("money_racks needs one rack for each player")
+        layouts = [get_money_balls(int(rack)) for rack in racks]
+
+        if model == "log_reg":
+            self.train(ids)
+        params = get_params_many(ids, model, k)
+        key = get_cache_key("contest", model, n, seed, sampling, bool(query.get("exact")), ids, layouts, contest_format, params)
+
+        if query.get("exact"):
+            pmfs = [get_score_pmf(playerid, model, money_balls, k=k) for playerid, money_balls in zip(ids, layouts)]
+            (probs, se), cached = self.run(key, exact_contest_probs_with_se, pmfs, *get_exact_format(contest_format, len(ids)))
+        else:
+            (wins, se), cached = self.run(key, run_contest_job, n, seed, params, layouts, model, sampling, contest_format)
+            probs = wins / n
+
+        players = [{"playerid": playerid, "name": name, "money_rack": int(rack), "prob": float(prob), "se": float(error),
+                    "odds": round(1 / prob, 2) if prob > 0 else None}
+                   for playerid, name, rack, prob, error in zip(ids, names, racks, probs, se)]
+        return {"model": model, "n": n, "seed": seed, "format": contest_format, "cached": cached, "players": players}
+
+    def price_player(self, query):
+        '''
+        Score distribution of one player's round. query gives playerid, and can give model, n, seed, sampling, exact, k and money_rack.
+        '''
+        playerid = str(query["playerid"])
+        model = query.get("model", "bayesian")
+        n = get_n(query)
+        seed = query.get("seed")
+        sampling = query.get("sampling", "iid")
+        if model not in ("bayesian", "log_reg"):
+            raise ValueError(f"Unknown model: {model}")
+        if sampling not in SAMPLING_STRATEGIES:
+            raise ValueError(f"Unknown sampling strategy: {sampling}")
+
+        money_balls = get_money_balls(int(query.get("money_rack", 4)))
+        if model == "log_reg":
+            self.train([playerid])
+        k = query.get("k")
+        params = get_params_many([playerid], model, k)[0]
+        key = get_cache_key("player", model, n, seed, sampling, bool(query.get("exact")), playerid, money_balls, params)
+
+        if query.get("exact"):
+            (pmf, mean, se), cached = self.run(key, exact_player_pmf, get_score_pmf(playerid, model, money_balls, k=k))
+        else:
+            (pmf, mean, se), cached = self.run(key, run_player_job, n, seed, params, money_balls, model, sampling)
+        return {"playerid": playerid, "name": get_name_by_id(playerid), "model": model, "n": n, "seed": seed, "cached": cached,
+                "mean": float(mean), "se": float(se), "pmf": [float(p) for p in pmf]}
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+def get_n(query):
+    n = int(query.get("n", 100000))
+    if n <= 0:
+        raise ValueError("n must be positive")
+    return n
+
+# Queries are cached by their arguments and the parameters they were priced with, so a change to the data is never served stale
+def get_cache_key(*args):
+    return json.dumps(args, default=lambda x: np.asarray(x).tolist())
+
+def exact_contest_probs_with_se(pmfs, num_finalists, tie_break):
+    probs = exact_contest_probs(pmfs, num_finalists, tie_break)
+    return probs, np.zeros(len(probs))
+
+def exact_player_pmf(pmf):
+    return pmf, float(np.arange(len(pmf)) @ pmf), 0.0
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        routes = {"/contest": service.price_contest, "/player": service.price_player}
+
+        def do_GET(self):
+            if self.path == "/health":
+                self.send_json(200, {"status": "ok"})
+            else:
+                self.send_json(404, {"error": f"Unknown path: {self.path}"})
+
+        def do_POST(self):
+            if self.path not in self.routes:
+                self.send_json(404, {"error": f"Unknown path: {self.path}"})
+                return
+            start = time.perf_counter()
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                query = json.loads(self.rfile.read(length) or b"{}")
+                response = self.routes[self.path](query)
+            except ServiceBusy as e:
+                self.send_json(503, {"error": str(e)})
+                return
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_json(400, {"error": repr(e)})
+                return
+            except Exception as e:
+                # Anything else (e.g. a failed download for an unknown player) still gets a reply
+                self.send_json(500, {"error": repr(e)})
+                return
+            response["elapsed_ms"] = round(1000 * (time.perf_counter() - start), 2)
+            self.send_json(200, response)
+
+        def send_json(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        # Keep the console quiet, one line per query is too much when traders poll
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+def serve(host="127.0.0.1", port=8000, workers=2, cache_size=256, max_pending=None, warm=True):
+    service = PricingService(workers, cache_size, max_pending)
+    if warm:
+        service.warm()
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    # Shut the worker pool down on SIGTERM too, not just Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"Pricing service listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
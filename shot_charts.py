@@ -0,0 +1,178 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from data_collection import get_registry
+
+# Seasons used to train the logistic regression models. The last one is still in progress, so it is always re-fetched.
+seasons = ["2021-22", "2022-23", "2023-24", "2024-25"]
+
+class TokenBucket:
+    '''
+    Rate limiter shared by every request thread.
+    Tokens refill at rate per second up to capacity, and each request takes one.
+    '''
+    def __init__(self, rate=1.0, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# Data collection from nba_api
+def fetch_player_index():
+    from nba_api.stats.endpoints import playerindex
+    return playerindex.PlayerIndex().get_data_frames()[0]
+
+def fetch_season(nba_api_id, season):
+    from nba_api.stats.endpoints import shotchartdetail
+    shotchart = shotchartdetail.ShotChartDetail(
+        team_id=0,
+        player_id=nba_api_id,
+        season_type_all_star='Regular Season',
+        season_nullable=season,
+        context_measure_simple='FG3A'
+    )
+    return shotchart.get_data_frames()[0]
+
+# Shot charts are stored per player and season as data/shot_charts/{playerid}/{season}.npz, with one array per column.
+# Only the columns below are kept, as compact integer types. The categorical columns are stored as int8 codes,
+# with their labels in a {column}_categories array alongside.
+shot_chart_columns = {
+    "GAME_ID": np.int32,
+    "GAME_DATE": np.int32,
+    "LOC_X": np.int16,
+    "LOC_Y": np.int16,
+    "SHOT_DISTANCE": np.int16,
+    "SHOT_MADE_FLAG": np.int8,
+}
+categorical_columns = ["SHOT_ZONE_AREA", "SHOT_TYPE", "ACTION_TYPE"]
+
+def get_season_path(playerid, season):
+    return f"data/shot_charts/{playerid}/{season}.npz"
+
+def write_season(shot_data, path):
+    import pandas as pd
+    shot_data = pd.DataFrame(shot_data, columns=list(shot_chart_columns) + categorical_columns)
+    arrays = dict()
+    for column, dtype in shot_chart_columns.items():
+        arrays[column] = pd.to_numeric(shot_data[column]).to_numpy(dtype=dtype)
+    for column in categorical_columns:
+        codes, categories = pd.factorize(shot_data[column], sort=True)
+        arrays[column] = np.asarray(codes, dtype=np.int8)
+        arrays[column + "_categories"] = np.array(categories, dtype=str)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(path + ".tmp", path)
+
+# Read the given columns (all of them by default) of one season. Only the requested arrays are read from the file.
+def read_season(playerid, season, columns=None):
+    import pandas as pd
+    if columns is None:
+        columns = list(shot_chart_columns) + categorical_columns
+    with np.load(get_season_path(playerid, season)) as data:
+        shots = dict()
+        for column in columns:
+            if column in categorical_columns:
+                shots[column] = pd.Categorical.from_codes(data[column], data[column + "_categories"])
+            else:
+                shots[column] = data[column]
+    return pd.DataFrame(shots, columns=columns)
+
+# Look up nba_api PERSON_IDs for any players that don't have one yet, downloading PlayerIndex at most once
+def resolve_nba_ids(playerids, fetch_player_index=fetch_player_index):
+    registry = get_registry()
+    if any(registry.get_nba_id(playerid) is None for playerid in playerids):
+        data = fetch_player_index()
+        nba_ids = dict()
+        for row in data.itertuples():
+            for player in registry.find_by_name(row.PLAYER_FIRST_NAME, row.PLAYER_LAST_NAME):
+                nba_ids.setdefault(player["playerid"], row.PERSON_ID)
+        registry.add_nba_ids(nba_ids)
+    return {playerid: registry.get_nba_id(playerid) for playerid in playerids}
+
+def ingest_shot_charts(playerids, seasons=seasons, workers=4, rate=1.0, refresh_current=True, fetch_season=fetch_season, fetch_player_index=fetch_player_index):
+    '''
+    Download shot charts for several players and seasons at once.
+    Requests run concurrently on a thread pool, but all go through one token bucket so the stats endpoints
+    see at most rate requests per second. Each (player, season) is stored separately, so only missing
+    seasons and the current season are fetched again.
+    The fetch functions can be replaced by a local stand-in for testing.
+    '''
+    nba_ids = resolve_nba_ids(playerids, fetch_player_index)
+    bucket = TokenBucket(rate)
+
+    def fetch(playerid, season):
+        bucket.acquire()
+        shot_data = fetch_season(nba_ids[playerid], season)
+        shot_data = shot_data[shot_data['ACTION_TYPE'] == 'Jump Shot']
+        write_season(shot_data, get_season_path(playerid, season))
+
+    convert_json_shot_charts(playerids, seasons)
+    jobs = []
+    for playerid in playerids:
+        for season in seasons:
+            if not os.path.exists(get_season_path(playerid, season)) or (refresh_current and season == seasons[-1]):
+                jobs.append((playerid, season))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() so that any failed request raises here
+        list(executor.map(lambda job: fetch(*job), jobs))
+
+def has_shot_chart(playerid, seasons=seasons):
+    return all(os.path.exists(get_season_path(playerid, season)) for season in seasons)
+
+def read_shot_chart(playerid, columns=None, seasons=seasons):
+    import pandas as pd
+    return pd.concat([read_season(playerid, season, columns) for season in seasons], ignore_index=True)
+
+# A player's shots over all seasons, downloading any seasons that aren't stored yet
+def load_shot_chart(playerid, columns=None):
+    convert_json_shot_charts([playerid])
+    if not has_shot_chart(playerid):
+        ingest_shot_charts([playerid])
+    return read_shot_chart(playerid, columns)
+
+# NBA game IDs hold the year the season started, e.g. 0022300123 is from 2023-24
+def get_season_from_game_id(game_id):
+    year = int(str(game_id).zfill(10)[3:5])
+    return f"20{year:02d}-{(year + 1) % 100:02d}"
+
+def convert_json_shot_charts(playerids, seasons=seasons):
+    '''
+    Convert shot charts saved by earlier versions as JSON records into the per-season arrays, so they don't need downloading again.
+    These are either per-season files (data/shot_charts/{playerid}/{season}.json) or one combined file for all
+    seasons (data/shot_charts/{playerid}.json), which is split up by the season in each shot's GAME_ID.
+    '''
+    for playerid in playerids:
+        for season in seasons:
+            json_path = f"data/shot_charts/{playerid}/{season}.json"
+            if os.path.exists(json_path) and not os.path.exists(get_season_path(playerid, season)):
+                with open(json_path, "r") as f:
+                    write_season(json.load(f), get_season_path(playerid, season))
+                os.remove(json_path)
+
+        json_path = f"data/shot_charts/{playerid}.json"
+        if os.path.exists(json_path) and not has_shot_chart(playerid, seasons):
+            with open(json_path, "r") as f:
+                shots = json.load(f)
+            for season in seasons:
+                if not os.path.exists(get_season_path(playerid, season)):
+                    write_season([shot for shot in shots if get_season_from_game_id(shot["GAME_ID"]) == season], get_season_path(playerid, season))
+            os.remove(json_path)
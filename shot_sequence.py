@@ -0,0 +1,142 @@
+import json
+import os
+import numpy as np
+from data_collection import MissingDataError
+from instrumentation import instrumented
+
+'''
+Sequential shot model, where the make probability of each ball depends on how the round has gone so far.
+On the logit scale, each shot's probability is the shooter model's theta plus
+    hot * (makes minus expected makes over the last STREAK_WINDOW shots)   streaks
+    fatigue * (shot index, from -0.5 on the first ball to 0.5 on the last)   tiring through the racks
+    pressure * (1 on money and dew balls, less their share of the round)   pressure on the balls worth more
+The fatigue and pressure terms are centred, and the streak term is measured against the shooter's own theta,
+so a shooter's average percentage stays close to the model's.
+
+    python contest.py fit-sequence
+    simulate("1050", "bayesian", 100000, sequential=True)
+    simulate_contest("bayesian", 100000, sequential=True)
+
+fit_sequence_model fits the three coefficients to the ordered shots of past contest rounds, and writes them to SEQUENCE_MODEL.
+'''
+
+SEQUENCE_MODEL = "data/shot_sequence_model.json"
+# Number of previous shots in the streak term
+STREAK_WINDOW = 3
+# Thetas are kept this far from 0 and 1 so their logits are finite
+EPSILON = 1e-6
+# Rounds stepped through the shots together. Small enough that a block's arrays stay in the CPU cache between steps.
+BLOCK_SIZE = 4096
+
+def get_sequence_params():
+    if not os.path.exists(SEQUENCE_MODEL):
+        raise MissingDataError(f"No sequential shot model at {SEQUENCE_MODEL}, fit one first with python contest.py fit-sequence")
+    with open(SEQUENCE_MODEL, "r") as f:
+        return json.load(f)
+
+# The fatigue and pressure terms of every ball in a round with the given points per ball
+def get_sequence_features(weights):
+    fatigue = np.arange(len(weights)) / (len(weights) - 1) - 0.5
+    pressure = (weights > 1) - np.mean(weights > 1)
+    return fatigue, pressure
+
+@instrumented("shot_sequence.sim_rounds_sequential")
+def sim_rounds_sequential(thetas, weights, n, sequence, uniforms):
+    '''
+    sim_rounds with the sequential shot model. thetas is (n, 27) or a row of 27, and uniforms is (n, 27).
+    Every round steps through the 27 shots together, so there are 27 vectorised steps for each block of rounds.
+    '''
+    thetas = np.broadcast_to(np.clip(thetas, EPSILON, 1 - EPSILON), (n, len(weights)))
+    fatigue, pressure = get_sequence_features(weights)
+    shift = np.exp(sequence["fatigue"] * fatigue + sequence["pressure"] * pressure)[:, None]
+
+    scores = np.empty(n, dtype=np.int64)
+    for start in range(0, n, BLOCK_SIZE):
+        # One row per shot, so each step works on contiguous memory
+        block_thetas = thetas[start:start + BLOCK_SIZE].T.copy()
+        block_uniforms = uniforms[start:start + BLOCK_SIZE].T.copy()
+        m = block_thetas.shape[1]
+        # The odds p / (1 - p) of each shot before the streak term
+        base_odds = block_thetas / (1 - block_thetas) * shift
+
+        makes = np.empty((len(weights), m), dtype=bool)
+        # Each shot's make (0 or 1) less its theta, and the running sum of that over the streak window
+        surprise = np.empty((len(weights), m))
+        streak = np.zeros(m)
+        for t in range(len(weights)):
+            # Drop the shot that has just left the window
+            if t > STREAK_WINDOW:
+                streak -= surprise[t - STREAK_WINDOW - 1]
+            odds = base_odds[t] * np.exp(sequence["hot"] * streak)
+            # u < odds / (1 + odds), without the division
+            np.less(block_uniforms[t] * (1 + odds), odds, out=makes[t])
+            np.subtract(makes[t], block_thetas[t], out=surprise[t])
+            streak += surprise[t]
+        scores[start:start + m] = weights @ makes
+    return scores
+
+def get_streaks(makes, rates):
+    # Makes less expected makes over the previous STREAK_WINDOW shots, before each shot of each round
+    surprise = makes - rates[:, None]
+    cumulative = np.concatenate([np.zeros((len(makes), 1)), np.cumsum(surprise, axis=1)], axis=1)
+    start = np.maximum(np.arange(makes.shape[1]) - STREAK_WINDOW, 0)
+    return cumulative[:, :-1] - cumulative[:, start]
+
+@instrumented("shot_sequence.fit_sequence_model")
+def fit_sequence_model(contests=None):
+    '''
+    Fit the hot, fatigue and pressure coefficients by maximum likelihood, from every round in the contest history
+    (see backtest.load_contest_history) whose players give their "shots": the 27 makes (1) and misses (0) of each
+    of their rounds, in shooting order. Each player gets their own intercept, which stands in for the shooter
+    model's theta, and the streak term is measured against their make rate over all their rounds.
+    Writes the coefficients to SEQUENCE_MODEL and returns them.
+    '''
+    import scipy.optimize
+    from backtest import load_contest_history
+    from simulate import get_weights, get_money_balls
+
+    if contests is None:
+        try:
+            contests = load_contest_history()
+        except MissingDataError as e:
+            raise MissingDataError(f"{e}. To fit the sequential model, players also need their \"shots\" in each round: "
+                                   f"a list of 27 makes (1) and misses (0) in shooting order per round") from e
+    makes, weights, players = [], [], []
+    for contest in contests:
+        for player in contest["players"]:
+            for shots in player.get("shots") or []:
+                makes.append(shots)
+                weights.append(get_weights(get_money_balls(player.get("money_rack", 4)), [10, 16]))
+                players.append(str(player["playerid"]))
+    if not makes:
+        raise ValueError("No rounds with ordered shots in the contest history to fit the sequential model to. Give players "
+                         "their \"shots\" in each round: a list of 27 makes (1) and misses (0) in shooting order per round")
+
+    makes = np.array(makes, dtype=np.float64)
+    playerids, index = np.unique(players, return_inverse=True)
+    num_players = len(playerids)
+    rates = np.clip(np.bincount(index, makes.sum(axis=1)) / np.bincount(index, np.full(len(makes), makes.shape[1])), EPSILON, 1 - EPSILON)
+    fatigue, pressure = np.array([get_sequence_features(w) for w in weights]).transpose(1, 0, 2)
+    features = np.stack([get_streaks(makes, rates[index]), fatigue, pressure], axis=-1)
+
+    def neg_loglik(x):
+        intercepts, coefs = x[:num_players], x[num_players:]
+        logits = intercepts[index][:, None] + features @ coefs
+        p = 1 / (1 + np.exp(-logits))
+        loglik = (makes * logits - np.logaddexp(0, logits)).sum()
+        residuals = makes - p
+        gradient = np.concatenate([np.bincount(index, residuals.sum(axis=1), minlength=num_players),
+                                   np.einsum("ij,ijk->k", residuals, features)])
+        return -loglik, -gradient
+
+    x0 = np.concatenate([np.log(rates) - np.log1p(-rates), np.zeros(3)])
+    # Bounded, so a player who made or missed everything can't send their intercept off to infinity
+    fit = scipy.optimize.minimize(neg_loglik, x0, jac=True, method="L-BFGS-B", bounds=[(-10, 10)] * (num_players + 3))
+    hot, fatigue, pressure = fit.x[num_players:]
+
+    sequence = {"hot": float(hot), "fatigue": float(fatigue), "pressure": float(pressure), "window": STREAK_WINDOW,
+                "num_rounds": len(makes), "loglik": float(-fit.fun)}
+    with open(SEQUENCE_MODEL + ".tmp", "w") as f:
+        json.dump(sequence, f)
+    os.replace(SEQUENCE_MODEL + ".tmp", SEQUENCE_MODEL)
+    return sequence
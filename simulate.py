@@ -1,75 +1,91 @@
-from collections import Counter
-import glob
-import heapq
+from concurrent.futures import ProcessPoolExecutor
 import os
-import scipy.stats
+import itertools
+import time
 import numpy as np
 import json
-import matplotlib.pyplot as plt
-from bayesian import get_probabilities as get_bayesian_probs
-from logistic_regression import get_probabilities_by_location
+# scipy and pandas are imported inside the functions that use them, so that importing this module stays cheap
+from bayesian import sample_probabilities as sample_bayesian_probs, update as get_bayesian_posterior, get_prior_settings, POSTERIOR_TABLE
+from logistic_regression import get_probabilities_by_location_many, train_models, CONTEST_UPLIFT
+from shot_sequence import sim_rounds_sequential, get_sequence_params
 from data_collection import load_participant_info, get_name_by_id
+from instrumentation import instrumented, count
+
+# Rounds or contests per chunk of work. Fixed so that results for a given seed don't depend on the number of workers.
+# A power of 2, so that each chunk splits into balanced Sobol sequences.
+CHUNK_SIZE = 2**17
+
+# Sampling strategies for the Monte Carlo:
+#   iid: independent draws from one stream per chunk.
+#   crn: common random numbers. Each (player, round) has its own stream derived from the seed, so with the same seed
+#        a player gets the same draws whatever the model or rack layout, and comparisons between them are paired.
+#   antithetic: crn, with each set of uniforms u used again as 1 - u.
+#   sobol: crn, with scrambled Sobol points in place of pseudo-random uniforms.
+SAMPLING_STRATEGIES = ["iid", "crn", "antithetic", "sobol"]
+
+# Independently scrambled Sobol sequences per chunk, which give the standard error estimate for sobol sampling
+SOBOL_REPLICATES = 8
 
 # By default, the last rack is the money rack and dew balls are shot after the second and third racks.
-def simulate(playerid, model="bayesian", n=1, commentary=False, money_balls=[4, 9, 15, 21, 22, 23, 24, 25, 26], dew_balls=[10,16]):
-    if model == "bayesian":
-        scores = simulate_bayesian(playerid, n, commentary, money_balls, dew_balls)
-    elif model == "log_reg":
-        scores = simulate_log_reg(playerid, n, commentary, money_balls, dew_balls)
-    else:
+# With exact=True, the exact score distribution is returned instead, where index i is the probability of scoring i.
+# With sequential=True, make probabilities depend on the shots before (see shot_sequence), which can only be simulated.
+# estimate_mean gives the mean score and its standard error for the chosen sampling strategy.
+@instrumented("simulate")
+def simulate(playerid, model="bayesian", n=1, commentary=False, money_balls=[4, 9, 15, 21, 22, 23, 24, 25, 26], dew_balls=[10,16], exact=False, seed=None, workers=1, sampling="iid",
+             sequential=False):
+    if model not in ("bayesian", "log_reg"):
         print("Choose an existing model")
         return []
-    return scores
+    if sampling not in SAMPLING_STRATEGIES:
+        raise ValueError(f"Unknown sampling strategy: {sampling}")
+    if sequential and (exact or commentary):
+        raise ValueError("The sequential shot model can only be simulated, without commentary")
 
-def simulate_bayesian(playerid, n, commentary, money_balls, dew_balls):
-    # n separate realisations of theta_reg and theta_dew according to beta posterior distribution
-    thetas_reg, thetas_dew = get_bayesian_probs(n, playerid)
-    scores = []
+    if exact:
+        return get_score_pmf(playerid, model, money_balls, dew_balls)
 
     if commentary:
-        print(f"Next participant: {get_name_by_id(playerid)}")
-
-    # For each simulation, take a value of theta_dew and theta_reg to be the shooting percentage for regular balls and dew balls.
-    for i in range(n):
-        thetas = [thetas_dew[i] if j in dew_balls else thetas_reg[i] for j in range(27)]
-        scores.append(sim_round(thetas, commentary, money_balls, dew_balls))
+        return simulate_with_commentary(playerid, model, n, money_balls, dew_balls, np.random.default_rng(seed))
 
-    return scores
+    params = get_params(playerid, model)
+    kwargs = {"params": params, "model": model, "money_balls": money_balls, "dew_balls": dew_balls, "sampling": sampling,
+              "sequence": get_sequence_params() if sequential else None}
+    chunks = run_chunks(sim_player_rounds, kwargs, n, seed, workers)
+    return np.concatenate(chunks) if chunks else np.array([], dtype=np.int64)
 
-def simulate_log_reg(playerid, n, commentary, money_balls, dew_balls):
-    scores = []
-    shot_pc_by_location = get_probabilities_by_location(playerid)
-    thetas = [shot_pc_by_location[0]]*5 + [shot_pc_by_location[1]] * 5 + [shot_pc_by_location[2]] * 5 + [shot_pc_by_location[3]] * 5 + [shot_pc_by_location[4]] * 5
-    thetas.insert(dew_balls[0], shot_pc_by_location[5])
-    thetas.insert(dew_balls[1], shot_pc_by_location[6])
-    for i in range(n):
-        scores.append(sim_round(thetas, commentary, money_balls, dew_balls))
+# Slow path, shooting one ball at a time so that each shot can be printed
+def simulate_with_commentary(playerid, model, n, money_balls, dew_balls, rng):
+    print(f"Next participant: {get_name_by_id(playerid)}")
+    thetas = get_thetas(get_params(playerid, model), model, n, dew_balls, rng)
+    thetas = np.broadcast_to(thetas, (n, 27))
+    return np.array([sim_round(thetas[i], True, money_balls, dew_balls, rng) for i in range(n)])
 
-    return scores
-
-def sim_round(thetas, commentary, money_balls, dew_balls):
+@instrumented("simulate.sim_round")
+def sim_round(thetas, commentary, money_balls, dew_balls, rng=None):
     '''
     Simulate 27 separate Bernoulli trials. 
-    In future extensions, percentages may change throughout contest,
+    Percentages may change throughout the contest (see the sequential shot model in shot_sequence),
     so position of money balls and dew balls is important.
     By default, last rack is the money rack and that dew balls are shot after the
     second and third racks.
     '''
+    import scipy.stats
+
     # Scale up thetas somehow? Both models currently have players underperforming.
     score = 0
     for i in range(27):
         if i in dew_balls:
-            x = scipy.stats.bernoulli.rvs(thetas[i])
+            x = scipy.stats.bernoulli.rvs(thetas[i], random_state=rng)
             score += 3 * x
             if commentary:
                 print(f"Dew ball: {"scores" if x else "misses"}")
         elif i in money_balls:
-            x = scipy.stats.bernoulli.rvs(thetas[i])
+            x = scipy.stats.bernoulli.rvs(thetas[i], random_state=rng)
             score += 2 * x
             if commentary:
                 print(f"Money ball: {"scores" if x else "misses"}")
         else:
-            x = scipy.stats.bernoulli.rvs(thetas[i])
+            x = scipy.stats.bernoulli.rvs(thetas[i], random_state=rng)
             score += x
             if commentary:
                 print(f"Regular ball: {"scores" if x else "misses"}")
@@ -77,54 +93,769 @@ def sim_round(thetas, commentary, money_balls, dew_balls):
         print(f"Total score: {score}")
     return score
 
-def simulate_contest(model="bayesian"):
+# Row i holds theta_reg[i] for every ball except the dew balls, which get theta_dew[i].
+def get_bayesian_thetas(thetas_reg, thetas_dew, dew_balls):
+    is_dew = np.isin(np.arange(27), dew_balls)
+    return np.where(is_dew, thetas_dew[:, None], thetas_reg[:, None])
+
+# One theta per ball in shooting order: five racks of five, with the two dew ball spots inserted.
+def get_log_reg_thetas(shot_pc_by_location, dew_balls):
+    thetas = [shot_pc_by_location[0]]*5 + [shot_pc_by_location[1]] * 5 + [shot_pc_by_location[2]] * 5 + [shot_pc_by_location[3]] * 5 + [shot_pc_by_location[4]] * 5
+    thetas.insert(dew_balls[0], shot_pc_by_location[5])
+    thetas.insert(dew_balls[1], shot_pc_by_location[6])
+    return np.array(thetas)
+
+# Points for each of the 27 balls. Dew balls take priority over money balls, as in sim_round.
+def get_weights(money_balls, dew_balls):
+    weights = np.ones(27, dtype=np.int64)
+    weights[money_balls] = 2
+    weights[dew_balls] = 3
+    return weights
+
+@instrumented("simulate.sim_rounds")
+def sim_rounds(thetas, weights, n, rng=None, uniforms=None, sequence=None):
+    '''
+    Vectorised equivalent of sim_round for n rounds at once.
+    thetas is either an (n, 27) matrix with one row of shooting percentages per round,
+    or a single row of 27 shared by every round. weights gives the points for each ball.
+    Every shot is decided by one uniform draw, and the scores are a matrix-vector product.
+    The (n, 27) uniforms can be passed in, otherwise they are drawn from rng.
+    With the coefficients of the sequential shot model as sequence, the shots are taken in order instead.
+    '''
+    if uniforms is None:
+        if rng is None:
+            rng = np.random.default_rng()
+        uniforms = rng.random((n, 27))
+    if sequence is not None:
+        return sim_rounds_sequential(thetas, weights, n, sequence, uniforms)
+    makes = uniforms < thetas
+    return makes @ weights
+
+# Files each model's parameters are built from. A change to any of them invalidates the cached parameters.
+def get_param_files(playerid, model):
+    if model == "bayesian":
+        return ["data/3ptfg_last_100.json", "data/shot_pc_by_dist.json", "data/results.json", POSTERIOR_TABLE]
+    elif model == "log_reg":
+        return [f"data/models/{playerid}_grid.npy"]
+    else:
+        raise ValueError(f"Unknown model: {model}")
+
+def get_fingerprint(paths):
+    fingerprint = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            fingerprint.append((path, stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            fingerprint.append((path, None, None))
+    return tuple(fingerprint)
+
+# (playerid, model, k) -> (fingerprint, params), filled once per process
+params_cache = dict()
+
+# Model parameters for a player: the Beta posterior for bayesian, or the shooting percentage at each spot for log_reg.
+# These are cached in memory, so repeated simulations only read the data files again if they have changed.
+# k overrides the model's scale factor: the prior weight for bayesian, or the contest uplift for log_reg.
+def get_params(playerid, model, k=None):
+    return get_params_many([playerid], model, k)[0]
+
+# get_params for several players, with any log_reg players not already cached looked up on their grids in one batch
+@instrumented("simulate.get_params")
+def get_params_many(playerids, model, k=None):
+    keys = [(str(playerid), model, k) for playerid in playerids]
+    missing = []
+    for playerid, key in zip(playerids, keys):
+        fingerprint = get_fingerprint(get_param_files(playerid, model))
+        if key not in params_cache or params_cache[key][0] != fingerprint:
+            missing.append(playerid)
+    count("simulate.get_params", cache_hit=len(playerids) - len(missing), cache_miss=len(missing))
+
+    if model == "bayesian":
+        params = [get_bayesian_posterior(playerid, k) for playerid in missing]
+    elif missing:
+        params = list(get_probabilities_by_location_many(missing, CONTEST_UPLIFT if k is None else k))
+    else:
+        params = []
+
+    # Building the parameters may have written to the data files (e.g. a newly trained model), so fingerprint again
+    for playerid, player_params in zip(missing, params):
+        params_cache[(str(playerid), model, k)] = (get_fingerprint(get_param_files(playerid, model)), player_params)
+    return [params_cache[key][1] for key in keys]
+
+# Thetas for n rounds with the given model parameters, in the shape expected by sim_rounds.
+# For bayesian, the Beta draws can be made from an (n, 2) array of uniforms instead of rng.
+@instrumented("simulate.get_thetas")
+def get_thetas(params, model, n, dew_balls, rng=None, uniforms=None):
+    if model == "bayesian":
+        thetas_reg, thetas_dew = sample_bayesian_probs(n, params, rng, uniforms)
+        return get_bayesian_thetas(thetas_reg, thetas_dew, dew_balls)
+    elif model == "log_reg":
+        return get_log_reg_thetas(params, dew_balls)
+    else:
+        raise ValueError(f"Unknown model: {model}")
+
+def sim_player_rounds(n, rng, params, model, money_balls, dew_balls, sampling="iid", key=(0, 0), rows=None, sequence=None):
+    '''
+    Simulate n rounds for one player with the given sampling strategy, returning their scores.
+    key identifies the (player, round) stream for common random numbers. If rows is given, only those
+    of the n rounds are returned, so a player keeps the same draws however many rounds they actually shoot.
+    '''
+    if sampling == "iid":
+        m = n if rows is None else len(rows)
+        return sim_rounds(get_thetas(params, model, m, dew_balls, rng), get_weights(money_balls, dew_balls), m, rng, sequence=sequence)
+
+    # 27 uniforms for the shots and 2 for the Beta draws
+    uniforms = get_uniforms(n, 29, rng, sampling, key)
+    if rows is not None:
+        uniforms = uniforms[rows]
+    return sim_rounds_from_uniforms(uniforms, params, model, money_balls, dew_balls, sequence)
+
+# Scores for one round per row of an (n, 29) array of uniforms: 27 for the shots and 2 for the Beta draws
+def sim_rounds_from_uniforms(uniforms, params, model, money_balls, dew_balls, sequence=None):
+    thetas = get_thetas(params, model, len(uniforms), dew_balls, uniforms=uniforms[:, 27:])
+    return sim_rounds(thetas, get_weights(money_balls, dew_balls), len(uniforms), uniforms=uniforms[:, :27], sequence=sequence)
+
+@instrumented("simulate.get_uniforms")
+def get_uniforms(n, d, rng, sampling="iid", key=()):
+    '''
+    n rows of d uniforms on [0, 1) for the given sampling strategy.
+    Apart from iid, the draws come from a stream derived from the chunk's seed and key alone.
+    '''
+    if sampling == "iid":
+        return rng.random((n, d))
+
+    seed_seq = rng.bit_generator.seed_seq
+    keyed_rng = np.random.default_rng(np.random.SeedSequence(seed_seq.entropy, spawn_key=seed_seq.spawn_key + tuple(key)))
+    if sampling == "crn":
+        return keyed_rng.random((n, d))
+    elif sampling == "antithetic":
+        half = keyed_rng.random(((n + 1) // 2, d))
+        return np.concatenate([half, 1 - half])[:n]
+    elif sampling == "sobol":
+        from scipy.stats import qmc
+        # Scrambled copies of one Sobol sequence stay correlated with each other, so each key's points are also
+        # shuffled. Every player then gets well spread points of their own, independent of everyone else's.
+        # Blocks that aren't a power of 2 (the last chunk of most runs) take the first points of the next power of 2 up.
+        blocks = [len(block) for block in np.array_split(np.arange(n), SOBOL_REPLICATES)]
+        return np.concatenate([keyed_rng.permutation(qmc.Sobol(d, scramble=True, seed=keyed_rng).random_base2(get_sobol_exponent(size))[:size])
+                               for size in blocks])
+    else:
+        raise ValueError(f"Unknown sampling strategy: {sampling}")
+
+# Smallest m with 2**m >= size
+def get_sobol_exponent(size):
+    return max(size - 1, 0).bit_length()
+
+def get_unit_means(x, sampling):
+    '''
+    Group the rows of x from one chunk into independent units, for estimating standard errors:
+    single rows for iid and crn, antithetic pairs, or whole Sobol replicates.
+    '''
+    n = len(x)
+    if sampling == "antithetic":
+        half = (n + 1) // 2
+        pairs = (x[:n - half] + x[half:]) / 2
+        return np.concatenate([pairs, x[n - half:half]])
+    elif sampling == "sobol":
+        return np.array([block.mean(axis=0) for block in np.array_split(x, SOBOL_REPLICATES) if len(block)])
+    return x
+
+# Sums needed for the standard error: the sum and sum of squares of the unit means, and the number of units
+def summarise_units(x, sampling):
+    units = np.asarray(get_unit_means(x, sampling), dtype=np.float64)
+    return (units.sum(axis=0), (units ** 2).sum(axis=0), len(units))
+
+def get_standard_error(summaries):
+    total = sum(summary[0] for summary in summaries)
+    total_sq = sum(summary[1] for summary in summaries)
+    count = sum(summary[2] for summary in summaries)
+    if count < 2:
+        return np.full(np.shape(total), np.nan)
+    variance = (total_sq - total ** 2 / count) / (count - 1)
+    return np.sqrt(np.maximum(variance, 0) / count)
+
+# Mean and standard error of the scores returned by simulate, taking the sampling strategy into account
+def estimate_mean(scores, sampling="iid"):
+    chunks = np.split(np.asarray(scores), np.cumsum(get_chunk_sizes(len(scores)))[:-1])
+    summaries = [summarise_units(chunk, sampling) for chunk in chunks if len(chunk)]
+    return np.mean(scores), get_standard_error(summaries)
+
+def get_chunk_sizes(n):
+    sizes = [CHUNK_SIZE] * (n // CHUNK_SIZE)
+    if n % CHUNK_SIZE:
+        sizes.append(n % CHUNK_SIZE)
+    return sizes
+
+@instrumented("simulate.run_chunks")
+def run_chunks(fn, kwargs, n, seed=None, workers=1, first_chunk=0):
+    '''
+    Split n simulations into chunks of CHUNK_SIZE and return the results of fn(chunk_size, rng, **kwargs) for each chunk, in order.
+    Every chunk gets an independent stream spawned from one SeedSequence, and the chunks are the same for any
+    number of workers, so a seed always gives bit-identical results.
+    first_chunk numbers the chunks from somewhere other than 0, so a run can be continued in batches.
+    '''
+    sizes = get_chunk_sizes(n)
+    parent = np.random.SeedSequence(seed)
+    # Same streams as parent.spawn(), but starting from first_chunk
+    seeds = [np.random.SeedSequence(parent.entropy, spawn_key=parent.spawn_key + (first_chunk + i,)) for i in range(len(sizes))]
+
+    if workers == 1 or len(sizes) <= 1:
+        return [run_chunk(fn, kwargs, size, chunk_seed) for size, chunk_seed in zip(sizes, seeds)]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run_chunk, itertools.repeat(fn), itertools.repeat(kwargs), sizes, seeds))
+
+def run_chunk(fn, kwargs, n, seed):
+    return fn(n, np.random.default_rng(seed), **kwargs)
+
+def score_pmf(thetas, weights):
+    '''
+    Exact score distribution of a round with fixed thetas, by convolving one ball at a time.
+    Index i of the result is the probability of scoring i points.
+    '''
+    pmf = np.zeros(weights.sum() + 1)
+    pmf[0] = 1
+    for theta, w in zip(np.clip(thetas, 0, 1), weights):
+        new_pmf = pmf * (1 - theta)
+        new_pmf[w:] += pmf[:-w] * theta
+        pmf = new_pmf
+    return pmf
+
+def beta_binomial_score_pmf(alpha, beta, weights):
+    '''
+    Exact score distribution of a group of balls sharing one theta ~ Beta(alpha, beta).
+    Given s makes out of N, every sequence has probability B(alpha + s, beta + N - s) / B(alpha, beta),
+    so we only need to count the ways of making s balls for each total score.
+    '''
+    import scipy.special
+
+    num_balls = len(weights)
+    ways = np.zeros((num_balls + 1, weights.sum() + 1))
+    ways[0, 0] = 1
+    for w in weights:
+        new_ways = ways.copy()
+        new_ways[1:, w:] += ways[:-1, :-w]
+        ways = new_ways
+
+    makes = np.arange(num_balls + 1)
+    p_sequence = np.exp(scipy.special.betaln(alpha + makes, beta + num_balls - makes) - scipy.special.betaln(alpha, beta))
+    return p_sequence @ ways
+
+@instrumented("simulate.get_score_pmf")
+def get_score_pmf(playerid, model, money_balls=[4, 9, 15, 21, 22, 23, 24, 25, 26], dew_balls=[10,16], k=None):
+    return get_pmf_from_params(get_params(playerid, model, k), model, money_balls, dew_balls)
+
+# Exact score distribution of a round with the given model parameters
+def get_pmf_from_params(params, model, money_balls=[4, 9, 15, 21, 22, 23, 24, 25, 26], dew_balls=[10,16]):
+    weights = get_weights(money_balls, dew_balls)
+    if model == "bayesian":
+        (alpha_reg, beta_reg, alpha_dew, beta_dew) = params
+        is_dew = np.isin(np.arange(27), dew_balls)
+        # theta_reg and theta_dew are independent, so the two groups of balls can be convolved
+        pmf_reg = beta_binomial_score_pmf(alpha_reg, beta_reg, weights[~is_dew])
+        pmf_dew = beta_binomial_score_pmf(alpha_dew, beta_dew, weights[is_dew])
+        return np.convolve(pmf_reg, pmf_dew)
+    elif model == "log_reg":
+        return score_pmf(get_log_reg_thetas(params, dew_balls), weights)
+    else:
+        raise ValueError(f"Unknown model: {model}")
+
+def exact_contest_probs(pmfs, num_finalists=3, tie_break="previous_round"):
+    '''
+    Exact win probabilities from each player's round score distribution, with the same rules as sim_contests
+    for a single cut to the final.
+    With previous_round tie breaks, every ordering of finalists is enumerated: its probability is built up from the lowest
+    finalist, who must beat everyone eliminated, and then the final is decided by order statistics of the final round.
+    Shoot-offs are priced by exact_shoot_off_probs.
+    '''
+    num_players = len(pmfs)
+    num_finalists = min(num_finalists, num_players)
+    size = max(len(pmf) for pmf in pmfs)
+    pmfs = np.array([np.pad(pmf, (0, size - len(pmf))) for pmf in pmfs])
+    if tie_break == "shoot_off":
+        return exact_shoot_off_probs(pmfs, num_finalists)
+    cdfs = np.cumsum(pmfs, axis=1)
+    below = cdfs - pmfs # P(score < s)
+
+    # P(player b finishes below player a when a scores s)
+    p_below = np.array([[cdfs[b] if a < b else below[b] for b in range(num_players)] for a in range(num_players)])
+
+    win_probs = np.zeros(num_players)
+    for order in itertools.permutations(range(num_players), num_finalists):
+        eliminated = [o for o in range(num_players) if o not in order]
+        lowest = order[-1]
+        v = pmfs[lowest] * np.prod(p_below[lowest, eliminated], axis=0)
+        for upper, lower in zip(order[-2::-1], order[:0:-1]):
+            # P(the finalists below finish in order when upper scores s), with level scores going to the player listed first
+            v = pmfs[upper] * (np.cumsum(v) if upper < lower else np.cumsum(v) - v)
+        p_order = v.sum()
+        if p_order == 0:
+            continue
+
+        # In the final, ties go to the higher first round finisher
+        for i, player in enumerate(order):
+            p_win = pmfs[player].copy()
+            for j, other in enumerate(order):
+                if j < i:
+                    p_win *= below[other]
+                elif j > i:
+                    p_win *= cdfs[other]
+            win_probs[player] += p_order * p_win.sum()
+
+    return win_probs
+
+def exact_shoot_off_probs(pmfs, num_finalists):
+    '''
+    Exact win probabilities when ties for the final, and for the win, go to sudden-death shoot-offs.
+    Every group g of players level on the lowest finalist's round and first shoot-off is enumerated with each choice
+    of finalists above it. The players still level with g after that lose to it with their pairwise sudden-death odds,
+    P(a beats b | a and b are not level). That is only approximate when three or more players are still level after
+    a shoot-off, which moves win probabilities by under 1e-5, so they are normalised.
+    '''
+    num_players = len(pmfs)
+    below = np.cumsum(pmfs, axis=1) - pmfs # P(score < s)
+    above = np.clip(1 - below - pmfs, 0, None) # P(score > s)
+    p_level = pmfs @ pmfs.T
+    p_beat = (pmfs @ below.T) / np.maximum(1 - p_level, 1e-300)
+
+    # Logs of the products over players, with zero factors counted apart
+    def log_zero(x):
+        zero = x <= 0
+        return np.log(np.where(zero, 1, x)), zero.astype(int)
+
+    # P(player finishes above round score s and first shoot-off d)
+    log_above, zero_above = log_zero(above[:, :, None] + pmfs[:, :, None] * above[:, None, :])
+    p_finalists = {}
+    for size in range(1, num_finalists + 1):
+        for g in itertools.combinations(range(num_players), size):
+            g = list(g)
+            p_lose = np.prod(p_beat[g], axis=0)
+            # P(player finishes below all of g when they score s and d)
+            log_below, zero_below = log_zero(below[:, :, None] + pmfs[:, :, None] * (below[:, None, :] + pmfs[:, None, :] * p_lose[:, None, None]))
+            log_cell, zero_cell = log_zero(np.prod(pmfs[g][:, :, None] * pmfs[g][:, None, :], axis=0))
+            others = np.setdiff1d(np.arange(num_players), g)
+            log_total = log_below[others].sum(axis=0) + log_cell
+            zero_total = zero_below[others].sum(axis=0) + zero_cell
+            uppers = list(itertools.combinations(others, num_finalists - size))
+            uppers = np.array(uppers, dtype=int).reshape(len(uppers), num_finalists - size)
+            logs = log_total + (log_above[uppers] - log_below[uppers]).sum(axis=1)
+            zeros = zero_total + (zero_above[uppers] - zero_below[uppers]).sum(axis=1)
+            probs = np.where(zeros == 0, np.exp(logs), 0).sum(axis=(1, 2))
+            for upper, p in zip(uppers, probs):
+                finalists = tuple(sorted(g + list(upper)))
+                p_finalists[finalists] = p_finalists.get(finalists, 0) + p
+
+    win_probs = np.zeros(num_players)
+    final_memo = {}
+    for finalists, p in p_finalists.items():
+        for player, p_win in final_shoot_off_probs(pmfs, below, finalists, final_memo).items():
+            win_probs[player] += p * p_win
+    return win_probs / win_probs.sum()
+
+def final_shoot_off_probs(pmfs, below, players, memo):
+    '''
+    P(each player wins a round between them, with the players level at the top shooting again until one is left).
+    '''
+    if players in memo:
+        return memo[players]
+    if len(players) == 1:
+        return {players[0]: 1.0}
+    p_top = {}
+    for size in range(1, len(players) + 1):
+        for top in itertools.combinations(players, size):
+            rest = [p for p in players if p not in top]
+            p_top[top] = (np.prod(pmfs[list(top)], axis=0) * np.prod(below[rest], axis=0)).sum()
+    win_probs = dict.fromkeys(players, 0.0)
+    for top, p in p_top.items():
+        if top != players:
+            for player, p_win in final_shoot_off_probs(pmfs, below, top, memo).items():
+                win_probs[player] += p * p_win
+    # Rounds where all of them are level are shot again
+    memo[players] = {player: p / (1 - p_top[players]) for player, p in win_probs.items()}
+    return memo[players]
+
+# Format of the contest: how many players go through after each round (the last round decides the winner),
+# and how a tie for the last place going through, or for the win, is broken:
+#   shoot_off: the tied players shoot sudden-death rounds until the tie is broken, as in the real contest.
+#   previous_round: the higher finisher in the previous round goes through. In the first round, the player listed first.
+# tie_break can also be a list with a rule for each round.
+CONTEST_FORMAT = {"advance": [3], "tie_break": "shoot_off"}
+TIE_BREAKS = ["shoot_off", "previous_round"]
+
+# A shoot-off score is appended to the tied players' scores as a base 41 digit, which keeps every earlier result ahead of it.
+# After MAX_SHOOT_OFFS tied shoot-offs in a row (vanishingly rare), the previous round decides.
+SHOOT_OFF_BASE = 41
+MAX_SHOOT_OFFS = 8
+
+# Advancement counts for each round, ending with 1 for the winner, and each round's tie break
+def get_rounds(contest_format, num_players):
+    advance = list(contest_format.get("advance", CONTEST_FORMAT["advance"])) + [1]
+    tie_breaks = contest_format.get("tie_break", CONTEST_FORMAT["tie_break"])
+    if isinstance(tie_breaks, str):
+        tie_breaks = [tie_breaks] * len(advance)
+    if len(tie_breaks) != len(advance):
+        raise ValueError(f"tie_break needs a rule for each of the {len(advance)} rounds")
+    for tie_break in tie_breaks:
+        if tie_break not in TIE_BREAKS:
+            raise ValueError(f"Unknown tie break: {tie_break}")
+    sizes = [num_players] + advance
+    if any(size <= next_size for size, next_size in zip(sizes, sizes[1:])):
+        raise ValueError(f"Fewer players must go through after each round, but the format has {num_players} players and advance {advance[:-1]}")
+    return advance, tie_breaks
+
+# The number of finalists and tie break for exact_contest_probs, which handles a single cut to the final with one tie break throughout
+def get_exact_format(contest_format, num_players):
+    advance, tie_breaks = get_rounds(contest_format, num_players)
+    if len(advance) != 2:
+        raise ValueError("Exact probabilities are only available for a single cut to the final")
+    if len(set(tie_breaks)) > 1:
+        raise ValueError("Exact probabilities need the same tie break in every round")
+    return advance[0], tie_breaks[0]
+
+def play_tournaments(n, num_batches, num_players, contest_format, shoot):
+    '''
+    Play num_batches batches of n tournaments in lockstep, one tournament per row, returning each batch's winners.
+    shoot(key, rows) returns player key[0]'s scores for each batch, where rows[b] are the tournaments of batch b they
+    shoot in (None when everyone shoots), and key is (player, round) or (player, round, attempt) for the
+    attempt-th shoot-off after a round.
+    '''
+    advance, tie_breaks = get_rounds(contest_format, num_players)
+    # The players still in each tournament, ordered by their finish in the previous round (field order to begin with)
+    players = [np.tile(np.arange(num_players, dtype=np.int16), (n, 1)) for _ in range(num_batches)]
+
+    for r, (num_advance, tie_break) in enumerate(zip(advance, tie_breaks)):
+        m = players[0].shape[1]
+        # Scores are at most 40
+        scores = [np.empty((n, m), dtype=np.int8) for _ in range(num_batches)]
+        for j in range(num_players):
+            if r == 0:
+                for b, player_scores in enumerate(shoot((j, r), [None] * num_batches)):
+                    scores[b][:, j] = player_scores
+                continue
+            where = [np.nonzero(batch == j) for batch in players]
+            if any(len(rows) for rows, _ in where):
+                for b, player_scores in enumerate(shoot((j, r), [rows for rows, _ in where])):
+                    scores[b][where[b]] = player_scores
+
+        keys = [get_keys(batch) for batch in scores]
+        if tie_break == "shoot_off":
+            shoot_offs(players, keys, num_players, num_advance, r, shoot)
+        for b in range(num_batches):
+            players[b] = get_advancing(players[b], keys[b], num_advance)
+
+    return [batch[:, 0] for batch in players]
+
+# Unique sort keys for an (n, m) array of scores, with level scores going to the player further left
+def get_keys(scores):
+    m = scores.shape[1]
+    return scores.astype(np.int64) * m + (m - 1 - np.arange(m))
+
+# The num_advance players with the highest keys in each row, ordered by finish
+def get_advancing(players, keys, num_advance):
+    top = np.argpartition(-keys, num_advance - 1, axis=1)[:, :num_advance]
+    top = np.take_along_axis(top, np.argsort(-np.take_along_axis(keys, top, axis=1), axis=1), axis=1)
+    return np.take_along_axis(players, top, axis=1)
+
+def shoot_offs(players, keys, num_players, num_advance, r, shoot):
+    '''
+    Sudden-death shoot-offs between the players tied for the last place going through, in every row where there is one.
+    Each shoot-off score is appended to the tied players' keys, and any still tied shoot again.
+    '''
+    num_batches = len(players)
+    m = players[0].shape[1]
+    columns = np.arange(m)
+    for attempt in range(1, MAX_SHOOT_OFFS + 1):
+        # The tied players in each batch, as (row, column) pairs
+        tied = []
+        for b in range(num_batches):
+            scores = keys[b] // m
+            ranked = -np.sort(-scores, axis=1)
+            level = ranked[:, num_advance - 1] == ranked[:, num_advance]
+            rows = np.nonzero(level)[0]
+            is_tied = scores[rows] == ranked[rows, num_advance - 1][:, None]
+            tied_rows, tied_cols = np.nonzero(is_tied)
+            tied.append((rows, rows[tied_rows], tied_cols))
+        if not any(len(rows) for rows, _, _ in tied):
+            return
+
+        extra = [np.zeros((len(rows), m), dtype=np.int64) for rows, _, _ in tied]
+        for j in range(num_players):
+            selected = [players[b][tied_rows, tied_cols] == j for b, (_, tied_rows, tied_cols) in enumerate(tied)]
+            rows = [tied_rows[is_player] for (_, tied_rows, _), is_player in zip(tied, selected)]
+            if not any(len(player_rows) for player_rows in rows):
+                continue
+            for b, player_scores in enumerate(shoot((j, r, attempt), rows)):
+                _, tied_rows, tied_cols = tied[b]
+                positions = np.searchsorted(tied[b][0], tied_rows[selected[b]])
+                extra[b][positions, tied_cols[selected[b]]] = player_scores
+
+        for b, (rows, _, _) in enumerate(tied):
+            scores = keys[b][rows] // m
+            keys[b][rows] = (scores * SHOOT_OFF_BASE + extra[b]) * m + (m - 1 - columns)
+
+@instrumented("simulate.sim_contests")
+def sim_contests(n, rng, params, model, contest_format=CONTEST_FORMAT, money_balls=[4, 9, 15, 21, 22, 23, 24, 25, 26], dew_balls=[10,16], sampling="iid", layouts=None,
+                 sequence=None):
+    '''
+    Simulate n contests at once for a field of any size, given a list of each player's model parameters.
+    Returns the number of wins for each player, and the sums summarise_units gives for their standard errors.
+    Rounds and tie breaks follow contest_format, and each player only shoots in the contests they are still in.
+    layouts gives each player's own money balls, in place of money_balls for everyone.
+    sequence gives the coefficients of the sequential shot model, if it is used.
+    '''
+    num_players = len(params)
+    if layouts is None:
+        layouts = [money_balls] * num_players
+    # Shoot-offs only involve a few contests, so their draws come from a stream per (player, round, attempt) of just that length
+    shoot_off_sampling = "iid" if sampling == "iid" else "crn"
+
+    def shoot(key, rows):
+        j = key[0]
+        if len(key) == 3:
+            return [sim_player_rounds(len(rows[0]), rng, params[j], model, layouts[j], dew_balls, shoot_off_sampling, key, sequence=sequence)]
+        return [sim_player_rounds(n, rng, params[j], model, layouts[j], dew_balls, sampling, key, rows[0], sequence)]
+
+    winners = play_tournaments(n, 1, num_players, contest_format, shoot)[0]
+    won = winners[:, None] == np.arange(num_players)
+    return np.bincount(winners, minlength=num_players), summarise_units(won, sampling)
+
+# With exact=True, win probabilities are calculated from each player's exact score distribution instead of sampled.
+# The standard error of each sampled win probability is returned under "se".
+# With tolerance set, contests are run in batches until every confidence interval is narrower than tolerance
+# (see simulate_contest_adaptive), with n as the most contests to run.
+# playerids gives a field of any size in place of this year's participants, and contest_format its rounds and tie breaks
+# (see CONTEST_FORMAT). exact=True only handles formats with a single cut to the final.
+# sequential=True simulates with the sequential shot model (see shot_sequence), which has no exact probabilities.
+@instrumented("simulate_contest")
+def simulate_contest(model="bayesian", n=1000, exact=False, seed=None, workers=1, sampling="iid", tolerance=None, target="prob", max_time=None, print_odds=True,
+                     playerids=None, contest_format=CONTEST_FORMAT, sequential=False):
+    ids, names = get_field(playerids)
+    get_rounds(contest_format, len(ids))
+    if sequential and exact:
+        raise ValueError("The sequential shot model can only be simulated")
+
+    # Only retrains logistic regression models whose shot charts or pipeline config have changed
+    if model == "log_reg":
+        train_models(ids, workers)
+    if tolerance is not None and not exact:
+        for state in simulate_contest_adaptive(model, tolerance, target, max_time=max_time, max_n=n, seed=seed, workers=workers, sampling=sampling,
+                                               playerids=ids, contest_format=contest_format, sequential=sequential):
+            pass
+        wins = np.array(state["wins"])
+        probs = np.array(state["probs"])
+        se = np.array(state["se"])
+        # The adaptive run stops as soon as every interval is narrow enough, so usually short of n
+        n = state["n"]
+    elif exact:
+        wins = None
+        probs = exact_contest_probs([get_score_pmf(id, model) for id in ids], *get_exact_format(contest_format, len(ids)))
+        se = np.zeros(len(ids))
+    else:
+        params = get_params_many(ids, model)
+        kwargs = {"params": params, "model": model, "contest_format": contest_format, "sampling": sampling,
+                  "sequence": get_sequence_params() if sequential else None}
+        results = run_chunks(sim_contests, kwargs, n, seed, workers)
+        wins = sum(result[0] for result in results)
+        probs = wins / n
+        se = get_standard_error([result[1] for result in results])
+
+    # Calculate the implied probabilities of each player winning
+    implied_probs = {names[i]: 100 * probs[i] for i in range(len(names)) if probs[i] > 0}
+    decimal_odds = {name: round(100 / implied_probs[name], 1) for name in implied_probs.keys()}
+    if print_odds:
+        print(implied_probs)
+        print(decimal_odds)
+
+    return {"playerids": ids, "names": names, "n": n, "wins": wins, "probs": probs, "se": se}
+
+def get_participants():
     try:
         f = open("data/participants.json")
     except FileNotFoundError:
         load_participant_info()
         f = open("data/participants.json")
     
-    n = 1000
     participants = json.load(f)
     f.close()
 
-    winners = []
+    ids = [participant["playerid"] for participant in participants]
+    names = [participant["firstname"] + " " + participant["surname"] for participant in participants]
+    return ids, names
+
+# The given players and their names, or this year's participants
+def get_field(playerids=None):
+    if playerids is None:
+        return get_participants()
+    ids = [str(playerid) for playerid in playerids]
+    return ids, [get_name_by_id(playerid) for playerid in ids]
+
+def simulate_contest_adaptive(model="bayesian", tolerance=0.005, target="prob", confidence=0.95, max_time=None, max_n=None, seed=None, workers=1, sampling="iid", state=None,
+                              playerids=None, contest_format=CONTEST_FORMAT, sequential=False):
+    '''
+    Run contests in batches until every player's confidence interval is narrower than tolerance, yielding the running state after each batch.
+    target="prob" measures the width of the interval on the win probability, and target="odds" the width on the decimal odds.
+    Stops early once max_time seconds or max_n contests are reached.
+    The state is plain JSON, so it can be saved and passed back in as state to resume a long run with the same random streams.
+    '''
+    if state is None:
+        ids, names = get_field(playerids)
+        state = {"model": model, "sampling": sampling, "contest_format": contest_format, "sequential": sequential, "playerids": ids, "names": names,
+                 "entropy": np.random.SeedSequence(seed).entropy, "chunks": 0, "n": 0,
+                 "wins": [0] * len(ids), "unit_sum": [0.0] * len(ids), "unit_sum_sq": [0.0] * len(ids), "units": 0}
+    else:
+        state = dict(state)
+    model = state["model"]
+    sampling = state["sampling"]
+
+    params = get_params_many(state["playerids"], model)
+    kwargs = {"params": params, "model": model, "contest_format": state.get("contest_format", CONTEST_FORMAT), "sampling": sampling,
+              "sequence": get_sequence_params() if state.get("sequential") else None}
+    import scipy.stats
+    z = scipy.stats.norm.ppf(0.5 + confidence / 2)
+    start = time.monotonic()
+
+    while True:
+        num_chunks = max(workers, 1)
+        if max_n is not None:
+            num_chunks = min(num_chunks, -(-(max_n - state["n"]) // CHUNK_SIZE))
+        batch_n = num_chunks * CHUNK_SIZE
+        if max_n is not None:
+            batch_n = min(batch_n, max_n - state["n"])
+
+        results = run_chunks(sim_contests, kwargs, batch_n, state["entropy"], workers, first_chunk=state["chunks"])
+        state["chunks"] += len(results)
+        state["n"] += batch_n
+        state["wins"] = (np.array(state["wins"]) + sum(result[0] for result in results)).tolist()
+        summary = (np.array(state["unit_sum"]), np.array(state["unit_sum_sq"]), state["units"])
+        summary = [summary] + [result[1] for result in results]
+        state["unit_sum"] = sum(s[0] for s in summary).tolist()
+        state["unit_sum_sq"] = sum(s[1] for s in summary).tolist()
+        state["units"] = sum(s[2] for s in summary)
+
+        wins = np.array(state["wins"])
+        probs = wins / state["n"]
+        se = get_standard_error(summary)
+        # A player who has never won (or always won) has no spread yet, so use a continuity-corrected binomial error instead
+        p_corrected = (wins + 0.5) / (state["n"] + 1)
+        se = np.where((wins == 0) | (wins == state["n"]), np.sqrt(p_corrected * (1 - p_corrected) / state["n"]), se)
+
+        low = np.clip(probs - z * se, 0, 1)
+        high = np.clip(probs + z * se, 0, 1)
+        if target == "prob":
+            widths = high - low
+        elif target == "odds":
+            with np.errstate(divide="ignore"):
+                widths = np.where(low > 0, 1 / low, np.inf) - 1 / high
+        else:
+            raise ValueError(f"Unknown target: {target}")
+
+        state["probs"] = probs.tolist()
+        state["se"] = se.tolist()
+        state["ci"] = np.stack([low, high], axis=1).tolist()
+        state["width"] = float(widths.max())
+
+        if state["width"] <= tolerance:
+            state["done"] = "converged"
+        elif max_n is not None and state["n"] >= max_n:
+            state["done"] = "max_n"
+        elif max_time is not None and time.monotonic() - start >= max_time:
+            state["done"] = "max_time"
+        else:
+            state["done"] = None
+
+        yield dict(state)
+        if state["done"]:
+            return
+
+# Balls in each of the five racks, in shooting order. The dew balls (10 and 16) are shot between racks.
+RACKS = [[0, 1, 2, 3, 4], [5, 6, 7, 8, 9], [11, 12, 13, 14, 15], [17, 18, 19, 20, 21], [22, 23, 24, 25, 26]]
+
+# Money balls when the given rack (0-4) is the money rack: the last ball of every rack, and the whole money rack
+def get_money_balls(money_rack=4):
+    return sorted(set(rack[-1] for rack in RACKS) | set(RACKS[money_rack]))
+
+@instrumented("sweep_scenarios")
+def sweep_scenarios(model="bayesian", layouts=[4], ks=None, n=10000, seed=None, workers=1, sampling="crn", contest_format=CONTEST_FORMAT):
+    '''
+    Win probabilities for every combination of rack layout and scale factor k, in one batched pass.
+    Each layout is a money rack (0-4) for every player, or a list with one money rack per participant.
+    ks are values of the model's scale factor: the prior weight for bayesian, or the contest uplift for log_reg.
+    Every scenario is scored against the same uniform draws, so differences between scenarios aren't lost in sampling noise.
+    Returns a table with one row per scenario and player.
+    '''
+    import pandas as pd
+
+    if sampling == "iid":
+        raise ValueError("Scenarios can only share draws with crn, antithetic or sobol sampling")
+    if sampling not in SAMPLING_STRATEGIES:
+        raise ValueError(f"Unknown sampling strategy: {sampling}")
+    if ks is None:
+        ks = [get_prior_settings()["k"] if model == "bayesian" else CONTEST_UPLIFT]
+
+    ids, names = get_participants()
+    racks = []
+    for layout in layouts:
+        if isinstance(layout, int):
+            layout = [layout] * len(ids)
+        if len(layout) != len(ids):
+            raise ValueError(f"Layout {layout} doesn't give a money rack for each of the {len(ids)} participants")
+        racks.append(list(layout))
 
-    # Delete any old stored logistic regression models/data
     if model == "log_reg":
-        shot_charts = glob.glob("data/shot_charts/*.json")
-        models = glob.glob("data/models/*.joblib")
-        for file in shot_charts + models:
-            os.remove(file)
-
-    for i in range(n):
-        scores = dict()
-        for participant in participants:
-            name = participant["firstname"] + " " + participant["surname"]
-            id = participant["playerid"]
-            scores[id] = {"name": name, "score": simulate(id, model=model)}
-        
-        # Take the 3 highest scorers
-        finalists = heapq.nlargest(3, scores.items(), key=lambda i: i[1]["score"])
-        final_scores = dict()
-        # For the 3 finalists, simulate another round and store their scores
-        for participant in finalists:
-            id = participant[0]
-            final_scores[id] = {"name": participant[1]["name"], "score": simulate(id, model=model)}
-        # Determines the winner of the contest
-        winner = max(final_scores.values(), key=lambda x:x["score"])["name"]
-        winners.append(winner)
+        train_models(ids, workers)
+    params = [get_params_many(ids, model, k) for k in ks]
+    kwargs = {"params": params, "layouts": [[get_money_balls(rack) for rack in layout] for layout in racks], "model": model,
+              "contest_format": contest_format, "sampling": sampling}
+    results = run_chunks(sim_scenario_contests, kwargs, n, seed, workers)
 
-    # Calculate the implied probabilities of each player winning
-    counts = Counter(winners)
-    implied_probs = {key: 100 * counts[key] / n for key in counts.keys()}
-    decimal_odds = {key: round(100 / implied_probs[key], 1) for key in counts.keys()}
-    print(implied_probs)
-    print(decimal_odds)
-    
-# scores = simulate(1314, model="log_reg", n=1000)
-# counts = Counter(scores)
-# plt.bar(counts.keys(), counts.values())
-# plt.show()
+    rows = []
+    for i, (layout, k) in enumerate(itertools.product(racks, ks)):
+        wins = sum(result[i][0] for result in results)
+        se = get_standard_error([result[i][1] for result in results])
+        for j in range(len(ids)):
+            rows.append({"scenario": i, "k": k, "playerid": ids[j], "name": names[j], "money_rack": layout[j], "prob": wins[j] / n, "se": se[j]})
+    return pd.DataFrame(rows)
+
+@instrumented("simulate.sim_scenario_contests")
+def sim_scenario_contests(n, rng, params, layouts, model, contest_format=CONTEST_FORMAT, dew_balls=[10,16], sampling="crn"):
+    '''
+    sim_contests for every (layout, k) scenario at once, given each k's list of player parameters and each layout's list of money balls per player.
+    Each player's uniforms for a round are drawn once and scored under every scenario, and in the first round,
+    scenarios that give a player the same parameters and money balls share the same scores.
+    Returns the wins and standard error sums for each scenario, in the order of itertools.product(layouts, params).
+    '''
+    scenarios = list(itertools.product(range(len(layouts)), range(len(params))))
+    num_players = len(params[0])
+
+    def shoot(key, rows):
+        j = key[0]
+        if len(key) == 3:
+            # Each scenario's shoot-off takes the first uniforms of the key's stream, one row per tied contest, the same
+            # draws as sim_contests would give it. The stream is drawn once, as long as the most ties in any scenario.
+            sizes = [len(scenario_rows) for scenario_rows in rows]
+            shoot_off_uniforms = get_uniforms(max(sizes), 29, rng, "crn", key)
+            uniforms = [shoot_off_uniforms[:size] for size in sizes]
+        else:
+            round_uniforms = get_uniforms(n, 29, rng, sampling, key)
+            uniforms = [round_uniforms if scenario_rows is None else round_uniforms[scenario_rows] for scenario_rows in rows]
+
+        scores = []
+        shared = dict()
+        for (layout, k), scenario_rows, scenario_uniforms in zip(scenarios, rows, uniforms):
+            money_balls = layouts[layout][j]
+            if scenario_rows is None:
+                if (tuple(money_balls), k) not in shared:
+                    shared[(tuple(money_balls), k)] = sim_rounds_from_uniforms(scenario_uniforms, params[k][j], model, money_balls, dew_balls)
+                scores.append(shared[(tuple(money_balls), k)])
+            else:
+                scores.append(sim_rounds_from_uniforms(scenario_uniforms, params[k][j], model, money_balls, dew_balls))
+        return scores
+
+    results = []
+    for winners in play_tournaments(n, len(scenarios), num_players, contest_format, shoot):
+        won = winners[:, None] == np.arange(num_players)
+        results.append((np.bincount(winners, minlength=num_players), summarise_units(won, sampling)))
+    return results
 
-simulate_contest("log_reg")
\ No newline at end of file
+if __name__ == "__main__":
+    simulate_contest("log_reg")